@@ -23,5 +23,9 @@ setuptools.setup(
     'requests',
     'python-magic',
     'httpx'
-  ]
+  ],
+  extras_require={
+    'columnar': ['pyarrow'],
+    'compression': ['zstandard', 'brotli']
+  }
 )
@@ -1,4 +1,22 @@
 name = "synthi"
 
-from .connection import Connection
-from .common import APIError
+from importlib import import_module
+
+# Importing synthi on its own stays cheap: the clients (and requests, httpx,
+# pandas behind them) are only imported the first time one is asked for, so
+# that scripts that only need part of the package don't pay for all of it.
+__lazy = {
+  'Connection': '.connection',
+  'APIError': '.common',
+  'AsyncConnection': '.aio',
+}
+
+def __getattr__(attr):
+  if attr not in __lazy:
+    raise AttributeError(f"module {__name__!r} has no attribute {attr!r}")
+  value = getattr(import_module(__lazy[attr], __name__), attr)
+  globals()[attr] = value
+  return value
+
+def __dir__():
+  return sorted(set(globals()) | set(__lazy))
@@ -0,0 +1 @@
+from .connection import AsyncConnection
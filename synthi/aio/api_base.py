@@ -0,0 +1,35 @@
+import asyncio
+
+from .common import gql_query
+from ..api_base import Query
+
+# Runs an operation (see synthi.api_base) by awaiting each request it yields,
+# so the async client shares all of its request building and response
+# handling with the sync one.
+async def drive(steps, perform):
+  result = None
+  error = None
+  while True:
+    try:
+      step = steps.throw(error) if error else steps.send(result)
+    except StopIteration as done:
+      return done.value
+
+    try:
+      result, error = await perform_step(step, perform), None
+    except Exception as e:
+      result, error = None, e
+
+# A gather's queries all go out at once, bounded by the connection's limiter
+# rather than by `workers`
+async def perform_step(step, perform):
+  if isinstance(step, Query):
+    return await perform(step)
+
+  return list(await asyncio.gather(*[perform(query) for query in step.queries], return_exceptions=step.errors))
+
+# Mixed in ahead of a sync API class to get its async counterpart: every
+# operation called on it gives back a coroutine.
+class AsyncAPI:
+  def _run(self, steps):
+    return drive(steps, lambda step: gql_query(step.query, connection=self._connection, **step.params))
@@ -0,0 +1,38 @@
+from ..common import gql_headers, gql_operations, gql_result, gql_multipart
+
+# The asyncio counterpart of synthi.common.gql_query. Requests are sent through
+# the connection's shared httpx client and only `connection.limiter` of them
+# are allowed in flight at once.
+async def gql_query(query, variables=dict(), file=None, connection=None, partial=False, progress=None, files=None):
+  if connection is None:
+    raise Exception("Connection info not provided")
+
+  headers = gql_headers(connection)
+  json_data = gql_operations(query, variables)
+  url = f"{connection.host}/graphql"
+
+  if file is not None:
+    files = { 'variables.file': file, **(files or {}) }
+
+  async with connection.limiter:
+    if not files:
+      headers['Content-Type'] = 'application/json'
+      r = await connection.client.post(url, headers=headers, content=json_data)
+    else:
+      encoder = gql_multipart(json_data, files, progress=progress)
+      headers['Content-Type'] = encoder.content_type
+      if hasattr(encoder, 'len'):
+        headers['Content-Length'] = str(encoder.len)
+
+      # httpx wants an async iterable from an AsyncClient. File reads still
+      # block, but only for one chunk at a time.
+      async def body():
+        for chunk in encoder:
+          yield chunk
+
+      try:
+        r = await connection.client.post(url, headers=headers, content=body())
+      finally:
+        encoder.close()
+
+  return gql_result(r.content, partial=partial)
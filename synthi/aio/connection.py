@@ -0,0 +1,56 @@
+import os
+import asyncio
+import httpx
+
+from .common import gql_query
+from .dataset import DatasetAPI
+from .transformation import TransformationAPI
+from .organization import OrganizationAPI
+from ..common import DEFAULT_POOL_SIZE, DEFAULT_RETRIES, DEFAULT_TIMEOUT
+from ..batch import DEFAULT_BATCH_SIZE
+from ..resolution_cache import ResolutionCache, DEFAULT_TTL, DEFAULT_MAXSIZE
+
+class AsyncConnection:
+  def __init__(self, host=None, api_key=None, pool_size=DEFAULT_POOL_SIZE, retries=DEFAULT_RETRIES,
+               timeout=DEFAULT_TIMEOUT, max_concurrency=None,
+               resolve_ttl=DEFAULT_TTL, resolve_cache_size=DEFAULT_MAXSIZE, batch_size=DEFAULT_BATCH_SIZE):
+    self.host    = host    or os.environ.get('SYNTHI_API_HOST')
+    self.api_key = api_key or os.environ.get('SYNTHI_API_KEY')
+
+    # httpx only retries failed connection attempts, never requests that
+    # already reached the server.
+    transport = httpx.AsyncHTTPTransport(
+      retries=retries,
+      limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+    )
+    self.client = httpx.AsyncClient(transport=transport, timeout=timeout)
+    self.max_concurrency = max_concurrency or pool_size
+    self.__limiter = None
+
+    self.resolution_cache = ResolutionCache(ttl=resolve_ttl, maxsize=resolve_cache_size)
+    self.batch_size = batch_size
+
+    self.dataset = DatasetAPI(connection=self)
+    self.organization = OrganizationAPI(connection=self)
+    self.transformation = TransformationAPI(connection=self)
+
+  # Caps how many requests this connection has in flight at once, no matter how
+  # many coroutines are gathered. It's created on first use so that it belongs
+  # to whichever event loop is actually running the requests.
+  @property
+  def limiter(self):
+    if not self.__limiter:
+      self.__limiter = asyncio.Semaphore(self.max_concurrency)
+    return self.__limiter
+
+  async def query(self, query, variables=dict(), file=None):
+    return await gql_query(query, variables, file, connection=self)
+
+  async def aclose(self):
+    await self.client.aclose()
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *exc_info):
+    await self.aclose()
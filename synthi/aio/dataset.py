@@ -0,0 +1,41 @@
+import io
+import asyncio
+from functools import partial
+
+from .api_base import AsyncAPI
+from .. import dataset
+from ..formats import decoder_for, accept_header
+
+# Everything but get() comes from synthi.dataset.DatasetAPI, with requests sent
+# through the event loop instead. get() downloads through the shared httpx
+# client and doesn't support streaming, the content cache or parallel ranges.
+class DatasetAPI(AsyncAPI, dataset.DatasetAPI):
+  async def get(self, uuid_or_name, raw=False, as_text=True, format=None, usecols=None, dtype=None):
+    uuid = await self._run(self._resolve_to_uuid(uuid_or_name))
+    connection = self._connection
+
+    if not uuid:
+      raise ValueError(f"Dataset not found for {uuid_or_name}")
+
+    headers = { 'Authorization': f"Api-Key {connection.api_key}" }
+    download_url = f"{connection.host}/dataset/{uuid}"
+    if format:
+      download_url = f"{download_url}?type={format}"
+
+    if not raw:
+      headers['Accept'] = accept_header()
+
+    async with connection.limiter:
+      response = await connection.client.get(download_url, headers=headers)
+
+    if raw:
+      if as_text:
+        return response.content.decode('utf-8')
+      else:
+        return response.content
+    else:
+      # Parsing is CPU bound, so keep it off the event loop to let other
+      # downloads make progress in the meantime.
+      decode = decoder_for(response.headers.get('Content-Type'), format)
+      loop = asyncio.get_running_loop()
+      return await loop.run_in_executor(None, partial(decode, io.BytesIO(response.content), usecols=usecols, dtype=dtype))
@@ -0,0 +1,5 @@
+from .api_base import AsyncAPI
+from .. import organization
+
+class OrganizationAPI(AsyncAPI, organization.OrganizationAPI):
+  pass
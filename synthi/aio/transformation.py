@@ -0,0 +1,5 @@
+from .api_base import AsyncAPI
+from .. import transformation
+
+class TransformationAPI(AsyncAPI, transformation.TransformationAPI):
+  pass
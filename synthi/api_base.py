@@ -1,19 +1,152 @@
-from .common import is_uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+
+from .common import is_uuid, gql_query
+from .batch import chunked, batch_document, batch_variables, batch_results
+
+# API operations are written once, for both the sync and the async client, as
+# generators that yield the GraphQL requests they need made and get each one's
+# result sent back in. All of the request building and response handling lives
+# in the operation; only actually sending requests differs between clients.
+# Here they're sent one after another (see APIBase._run), while
+# synthi.aio.api_base awaits them.
+#
+# `params` are gql_query's keyword arguments (variables, file, files, partial,
+# progress).
+Query = namedtuple('Query', 'query params')
+
+def query(document, **params):
+  return Query(document, params)
+
+# Several queries that don't depend on each other. The async client sends them
+# all at once, and here they go through `workers` threads (or one by one). The
+# result is a list in the same order. With `errors`, a failed query gives back
+# its exception in place of a result rather than failing the whole lot.
+Gather = namedtuple('Gather', 'queries workers errors')
+
+def gather(queries, workers=None, errors=False):
+  return Gather(list(queries), workers, errors)
+
+# Marks a generator method as an API operation: calling it runs the operation
+# through the client's _run (so on the async client, calling it gives back a
+# coroutine). Other operations can get at the generator itself to run it as
+# part of their own with: yield from self.meta.steps(...)
+class operation:
+  def __init__(self, steps):
+    self.steps = steps
+    wraps(steps)(self)
+
+  def __get__(self, api, owner=None):
+    if api is None:
+      return self
+
+    @wraps(self.steps)
+    def run(*args, **kwargs):
+      return api._run(self.steps(api, *args, **kwargs))
+    run.steps = partial(self.steps, api)
+    return run
+
+# Runs an operation to the end, handing it the result of each request it
+# yields. `perform` sends a single query.
+def drive(steps, perform):
+  result = None
+  error = None
+  while True:
+    try:
+      step = steps.throw(error) if error else steps.send(result)
+    except StopIteration as done:
+      return done.value
+
+    try:
+      result, error = perform_step(step, perform), None
+    except Exception as e:
+      result, error = None, e
+
+def perform_step(step, perform):
+  if isinstance(step, Query):
+    return perform(step)
+
+  def attempt(query):
+    try:
+      return perform(query)
+    except Exception as e:
+      if not step.errors:
+        raise
+      return e
+
+  if step.workers and step.workers > 1 and len(step.queries) > 1:
+    with ThreadPoolExecutor(max_workers=step.workers) as pool:
+      return list(pool.map(attempt, step.queries))
+  return [attempt(query) for query in step.queries]
 
 class APIBase:
   def __init__(self, connection):
     self._connection = connection
 
+  # How operations get their requests sent. The async client overrides this.
+  def _run(self, steps):
+    return drive(steps, lambda step: gql_query(step.query, connection=self._connection, **step.params))
+
 class OrganizationAwareAPI(APIBase):
+  # Used to keep names of different kinds of objects apart in the connection's
+  # resolution cache. Subclasses should override this.
+  _kind = None
+
   def _default_organization(self):
-    return self._connection.organization.default()
+    return self._connection.organization.default.steps()
 
   def _resolve_to_uuid(self, uuid_or_name):
     if not is_uuid(uuid_or_name):
-      info = self.meta(uuid_or_name)
+      cache = self._connection.resolution_cache
+      org = (yield from self._default_organization())['uuid']
+
+      uuid = cache.get(org, self._kind, uuid_or_name)
+      if uuid:
+        return uuid
+
+      info = yield from self.meta.steps(uuid_or_name)
       if info:
+        cache.set(org, self._kind, uuid_or_name, info['uuid'])
         return info['uuid']
       else:
         return None
     else:
-      return uuid_or_name
\ No newline at end of file
+      return uuid_or_name
+
+  def _remember(self, info):
+    if info and 'name' in info and 'uuid' in info:
+      org = (yield from self._default_organization())['uuid']
+      self._connection.resolution_cache.set(org, self._kind, info['name'], info['uuid'])
+
+  def _forget(self, uuid=None, name=None):
+    self._connection.resolution_cache.invalidate(kind=self._kind, uuid=uuid, name=name)
+
+  # Fill the resolution cache with a single list() call, rather than paying for
+  # a meta() call the first time each name gets used.
+  @operation
+  def warm_cache(self):
+    items = yield from self.list.steps()
+    for info in items:
+      yield from self._remember(info)
+    return len(items)
+
+  # Runs `field` once per key, packing up to `batch_size` of them into each
+  # request. See synthi.batch for how the document and variables are built.
+  def _batch(self, operation, shared_types, item_types, field, keys, shared, items, convert=None, batch_size=None):
+    batch_size = batch_size or self._connection.batch_size
+
+    chunks = list(chunked(list(zip(keys, items)), batch_size))
+    queries = [
+      query(
+        batch_document(operation, shared_types, item_types, field, len(chunk)),
+        variables=batch_variables(shared, [item for _, item in chunk]),
+        partial=True
+      ) for chunk in chunks
+    ]
+
+    results = []
+    for chunk, (data, errors) in zip(chunks, (yield gather(queries))):
+      results += batch_results([key for key, _ in chunk], data, errors, convert)
+
+    return results
@@ -0,0 +1,78 @@
+import re
+from collections import namedtuple
+
+from .common import APIError
+
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_FILES_PER_REQUEST = 10
+DEFAULT_UPLOAD_WORKERS = 4
+
+# One entry per requested object, in the order they were asked for. Exactly one
+# of `result` and `error` is meaningful: a failure for one object doesn't stop
+# the rest of the batch from going through.
+BatchItem = namedtuple('BatchItem', ['key', 'result', 'error'])
+
+def chunked(items, size):
+  for i in range(0, len(items), size):
+    yield items[i:i+size]
+
+# Builds a single GraphQL document that repeats `field` once per item, aliased
+# as item0, item1, ... Variables named in `item_types` get the item index
+# appended, so each copy of the field reads its own arguments, while the ones
+# in `shared_types` are declared once and used by every copy. For example:
+#
+#   batch_document('query', {'org': 'OrganizationRef'}, {'name': 'String'},
+#                  'dataset(org: $org, name: $name) { uuid }', 2)
+#
+# produces:
+#
+#   query ($org: OrganizationRef, $name0: String, $name1: String) {
+#     item0: dataset(org: $org, name: $name0) { uuid }
+#     item1: dataset(org: $org, name: $name1) { uuid }
+#   }
+def batch_document(operation, shared_types, item_types, field, count):
+  item_var = re.compile(r'\$(' + '|'.join(item_types) + r')\b')
+
+  params = [f"${name}: {type}" for name, type in shared_types.items()]
+  fields = []
+  for i in range(count):
+    params += [f"${name}{i}: {type}" for name, type in item_types.items()]
+    fields.append(f"item{i}: " + item_var.sub(lambda m: f"${m.group(1)}{i}", field))
+
+  return f"{operation} ({', '.join(params)}) {{\n  " + "\n  ".join(fields) + "\n}"
+
+def batch_variables(shared, items):
+  variables = dict(shared)
+  for i, item in enumerate(items):
+    for name, value in item.items():
+      variables[f"{name}{i}"] = value
+  return variables
+
+# Errors carry the alias they belong to as the first element of their `path`.
+# Anything without one (a malformed document, an auth failure) applies to the
+# whole chunk.
+def batch_results(keys, data, errors, convert=None):
+  item_errors = {}
+  general_errors = []
+  for error in errors:
+    path = error.get('path') or []
+    if path and str(path[0]).startswith('item'):
+      item_errors.setdefault(path[0], []).append(error)
+    else:
+      general_errors.append(error)
+
+  results = []
+  for i, key in enumerate(keys):
+    alias = f"item{i}"
+    errors = item_errors.get(alias, []) + general_errors
+    if errors:
+      results.append(BatchItem(key, None, APIError(errors)))
+      continue
+
+    try:
+      result = convert(data.get(alias)) if convert else data.get(alias)
+      results.append(BatchItem(key, result, None))
+    except Exception as e:
+      results.append(BatchItem(key, None, e))
+
+  return results
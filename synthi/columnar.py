@@ -0,0 +1,74 @@
+# Typed, columnar copies of CSV datasets, so that repeated reads can skip CSV
+# parsing altogether. Feather files are memory-mapped, so reading one in full
+# doesn't copy it into memory first; Parquet files are smaller on disk and can
+# skip whole row groups when reading with filters. Both need pyarrow, which is an optional dependency.
+FORMATS = ('feather', 'parquet')
+
+# Each block of CSV read becomes one record batch / row group
+BLOCK_SIZE = 16 * 1024 * 1024
+
+def pyarrow():
+  try:
+    import pyarrow
+    return pyarrow
+  except ImportError:
+    raise ImportError("Columnar caching needs pyarrow, which can be installed with: pip install synthi[columnar]")
+
+def check_format(columnar_format):
+  if columnar_format not in FORMATS:
+    raise ValueError(f"Unknown columnar format {columnar_format}, should be one of {', '.join(FORMATS)}")
+
+# Streams CSV from `source` (an open binary file) into `path`, a block at a
+# time. Returns False without writing anything useful if pyarrow couldn't
+# settle on column types, e.g. if a column that looked like integers in the
+# first block has text further down. Callers should fall back on CSV then.
+def convert(source, path, columnar_format):
+  pa = pyarrow()
+  from pyarrow import csv, ipc, parquet
+
+  try:
+    reader = csv.open_csv(source, read_options=csv.ReadOptions(block_size=BLOCK_SIZE))
+    if columnar_format == 'feather':
+      with pa.OSFile(path, 'wb') as sink, ipc.new_file(sink, reader.schema) as writer:
+        for batch in reader:
+          writer.write_batch(batch)
+    else:
+      with parquet.ParquetWriter(path, reader.schema) as writer:
+        for batch in reader:
+          writer.write_table(pa.Table.from_batches([batch]))
+  except pa.ArrowInvalid:
+    return False
+
+  return True
+
+# `usecols` and `filters` are applied before anything gets converted to pandas.
+# `filters` uses the same format as pyarrow.parquet.read_table, e.g.
+# [('species', '=', 'setosa'), ('petal_width', '>', 1)], and can be on columns
+# that aren't in `usecols`. Going through pyarrow.dataset means Parquet row
+# groups whose statistics rule out a match are skipped without being read.
+def read(path, columnar_format, usecols=None, dtype=None, chunksize=None, filters=None):
+  pyarrow()
+  from pyarrow import dataset, fs, parquet
+
+  expression = parquet.filters_to_expression(filters) if filters else None
+  if columnar_format == 'feather':
+    # Uncompressed IPC batches are read straight out of the mapped file
+    source = dataset.dataset(path, format='ipc', filesystem=fs.LocalFileSystem(use_mmap=True))
+  else:
+    source = dataset.dataset(path, format='parquet')
+
+  if chunksize:
+    return iter_frames(source.to_batches(columns=usecols, filter=expression, batch_size=chunksize), dtype=dtype)
+
+  return to_pandas(source.to_table(columns=usecols, filter=expression), dtype=dtype)
+
+def iter_frames(batches, dtype=None):
+  pa = pyarrow()
+  for batch in batches:
+    # Filtering can leave nothing of a batch
+    if batch.num_rows:
+      yield to_pandas(pa.Table.from_batches([batch]), dtype=dtype)
+
+def to_pandas(table, dtype=None):
+  df = table.to_pandas()
+  return df.astype(dtype) if dtype else df
@@ -1,8 +1,16 @@
 import re
 import os
 import requests
-import mimetypes
 import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .multipart import MultipartEncoder, UploadFile
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+DEFAULT_TIMEOUT = 60
 
 class APIError(ValueError):
   def __init__(self, graphql_error_list):
@@ -17,73 +25,116 @@ def is_uuid(str):
   else:
     return False
 
+# A single session keeps its TCP/TLS connections alive between requests, so
+# everything that talks to the same host should share one. Retries only kick in
+# for connection failures and gateway errors. urllib3 won't retry a POST on a
+# read error or bad status, which is what we want for non-idempotent mutations.
+def create_session(pool_size=DEFAULT_POOL_SIZE, retries=DEFAULT_RETRIES, backoff_factor=DEFAULT_BACKOFF_FACTOR):
+  retry = Retry(
+    total=retries,
+    backoff_factor=backoff_factor,
+    status_forcelist=(502, 503, 504),
+    raise_on_status=False
+  )
+  adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+  session = requests.Session()
+  session.mount('http://', adapter)
+  session.mount('https://', adapter)
+
+  return session
+
 # This can take a regular graphql query (with no actual file upload) or one
-# that also includes a single upload. To modify in order to take multiple
-# files, we'd have to review the following spec and modify as necessary:
+# that also includes uploads, following:
 #
 # https://github.com/jaydenseric/graphql-multipart-request-spec
-def gql_query(query, variables=dict(), file=None, connection=None):
+#
+# `file` is shorthand for a single upload filling in `variables.file`. For
+# several, `files` maps each variable path (e.g. 'variables.file3') to what
+# should be sent for it. Each can be a path, a file-like object or a
+# DataFrame. Contents are streamed to the server rather than read into memory
+# first, and `progress`, if given, gets called with (bytes_sent, total_bytes)
+# as the upload goes.
+def gql_query(query, variables=dict(), file=None, connection=None, partial=False, progress=None, files=None):
   if connection is None:
     raise Exception("Connection info not provided")
   
-  headers = {
-    'Authorization': f"Api-Key {connection.api_key}"
-  }
-
-  escaped_gql = (query
-    .strip()
-    .replace('\n', '\\n')
-    .replace('"', '\\"'))
+  headers = gql_headers(connection)
+  json_data = gql_operations(query, variables)
 
-  gql_json = dict(
-    query = query.strip(),
-    variables = variables
-  )
-  
-  json_data = json.dumps(gql_json)
+  if file is not None:
+    files = { 'variables.file': file, **(files or {}) }
 
-  data = None
-  files = None
-  
-  # Depending on whether or not there's a file that we have to send along with the
+  # Depending on whether or not there are files that we have to send along with the
   # regular JSON data, we can either do a fairly simple post, where we just send
   # the JSON as the data body of the post request, or a more complex one where we
   # need to follow the GraphQL multipart form specification.
-  if not file:
+  if not files:
     data = json_data
     headers['Content-Type'] = 'application/json'
   else:
-    fileName = os.path.basename(file)
-    mimetype, encoding = mimetypes.guess_type(file)
     # See: https://github.com/cybera/synthi/blob/master/manual/src/sections/ExportingAndImporting.md
     # for the curl command this is based off of.
-    files = {
-      'operations': (None, json_data, 'application/json'),
-      'map': (None, '{ "0": ["variables.file"] }', 'application/json'),
-      '0': (fileName, open(file, 'rb'), mimetype)
-    }
+    data = gql_multipart(json_data, files, progress=progress)
+    headers['Content-Type'] = data.content_type
+
+  try:
+    r = connection.session.post(f"{connection.host}/graphql", headers=headers, data=data, timeout=connection.timeout)
+  finally:
+    if files:
+      data.close()
+
+  return gql_result(r.content, partial=partial)
 
-  r = requests.post(f"{connection.host}/graphql", headers=headers, data=data, files=files)
+# Numbers each upload and builds the `map` from those numbers back to the
+# variables they belong in.
+def gql_multipart(operations, files, progress=None):
+  paths = list(files)
+  return MultipartEncoder(
+    operations,
+    { str(i): [path] for i, path in enumerate(paths) },
+    { str(i): UploadFile(files[path]) for i, path in enumerate(paths) },
+    progress=progress
+  )
+
+def gql_headers(connection):
+  return {
+    'Authorization': f"Api-Key {connection.api_key}"
+  }
 
+def gql_operations(query, variables=dict()):
+  gql_json = dict(
+    query = query.strip(),
+    variables = variables
+  )
+  
+  return json.dumps(gql_json)
+
+# Shared by the sync and async clients to turn a raw GraphQL response body into
+# its data, raising any errors the server reported. With `partial`, a GraphQL
+# server can answer some fields and fail others in the same response, so we
+# hand back both the data and the error list and leave sorting them out to
+# the caller.
+def gql_result(content, partial=False):
   json_content = {}
 
   try:
-    json_content = json.loads(r.content)
+    json_content = json.loads(content)
   except Exception as e:
     print("gql_query problem: ")
     if not json_content:
-      print(f"Can't parse JSON for {r.content}")
+      print(f"Can't parse JSON for {content}")
     raise(e)
 
-  if 'errors' in json_content:
+  if partial and ('data' in json_content or 'errors' in json_content):
+    return json_content.get('data') or {}, json_content.get('errors') or []
+  elif 'errors' in json_content:
     raise APIError(json_content['errors'])
   elif 'data' in json_content:
     return json_content['data']
   else:
     raise Exception(f"Can't get result data from:\n{json_content}")
 
-  return json_content['data']
-
 def read_code(path:str):
   if path and os.path.exists(path):
     with open(path, 'r') as file:
@@ -1,18 +1,54 @@
 import os
 
-from .common import gql_query
+from .common import gql_query, create_session, DEFAULT_POOL_SIZE, DEFAULT_RETRIES, DEFAULT_BACKOFF_FACTOR, DEFAULT_TIMEOUT
+from .batch import DEFAULT_BATCH_SIZE
+from .resolution_cache import ResolutionCache, DEFAULT_TTL, DEFAULT_MAXSIZE
+from .content_cache import ContentCache, DEFAULT_MAX_BYTES
+from .columnar import check_format
 from .dataset import DatasetAPI
 from .transformation import TransformationAPI
 from .organization import OrganizationAPI
 
 class Connection:
-  def __init__(self, host=None, api_key=None):
+  def __init__(self, host=None, api_key=None, pool_size=DEFAULT_POOL_SIZE, retries=DEFAULT_RETRIES,
+               backoff_factor=DEFAULT_BACKOFF_FACTOR, timeout=DEFAULT_TIMEOUT,
+               resolve_ttl=DEFAULT_TTL, resolve_cache_size=DEFAULT_MAXSIZE, batch_size=DEFAULT_BATCH_SIZE,
+               cache_dir=None, cache_max_bytes=DEFAULT_MAX_BYTES, cache_format=None):
     self.host    = host    or os.environ.get('SYNTHI_API_HOST')
     self.api_key = api_key or os.environ.get('SYNTHI_API_KEY')
 
+    # Every GraphQL call and dataset download goes through this session so that
+    # we only pay for connection setup once per host.
+    self.session = create_session(pool_size=pool_size, retries=retries, backoff_factor=backoff_factor)
+    self.timeout = timeout
+
+    # Name -> uuid lookups shared by the dataset and transformation APIs
+    self.resolution_cache = ResolutionCache(ttl=resolve_ttl, maxsize=resolve_cache_size)
+
+    # The most operations the *_many methods will pack into a single request
+    self.batch_size = batch_size
+
+    # Downloaded datasets are only kept on disk if asked for
+    cache_dir = cache_dir or os.environ.get('SYNTHI_CACHE_DIR')
+    self.content_cache = ContentCache(cache_dir, max_bytes=cache_max_bytes) if cache_dir else None
+
+    # 'feather' or 'parquet' to also keep a parsed copy of cached CSV datasets
+    if cache_format:
+      check_format(cache_format)
+    self.cache_format = cache_format
+
     self.dataset = DatasetAPI(connection=self)
     self.organization = OrganizationAPI(connection=self)
     self.transformation = TransformationAPI(connection=self)
   
   def query(self, query, variables=dict(), file=None):
-    gql_query(query, variables, file, connection=self)
+    return gql_query(query, variables, file, connection=self)
+
+  def close(self):
+    self.session.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
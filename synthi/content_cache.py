@@ -0,0 +1,256 @@
+import os
+import re
+import json
+from uuid import uuid4
+from tempfile import NamedTemporaryFile
+
+from . import columnar
+
+DEFAULT_MAX_BYTES = 2 * 1024**3
+CHUNK_SIZE = 1024 * 1024
+
+# Columnar copies are derived from the .data file next to them and live and
+# die with it.
+DERIVED_SUFFIXES = tuple(f".{columnar_format}" for columnar_format in columnar.FORMATS)
+
+# Keeps downloaded dataset contents on disk, keyed by dataset uuid and format,
+# along with the ETag/Last-Modified the server sent for them. Those go back as
+# If-None-Match/If-Modified-Since on the next download, so an unchanged dataset
+# costs a 304 instead of the whole body.
+#
+# Several processes can share one directory. Every stored copy of a dataset
+# gets a version of its own, which its data (and columnar copy) files are
+# named by. The .json file with the validators names the version they belong
+# to and is written last, replacing the previous one in a single rename. So
+# whatever a reader finds there, validators and contents always go together,
+# however stores from several processes interleave or if one dies halfway.
+# Once the directory grows past `max_bytes`, the least recently used datasets
+# are removed.
+#
+# `entry` below is what meta() returned. Passing the same one along from
+# validators() to open() makes sure the contents are those the validators
+# were sent for, even if another process stores a newer copy in between.
+#
+# Optionally, a typed columnar copy (see synthi.columnar) can be kept next to
+# each dataset so that it doesn't need to be parsed again.
+class ContentCache:
+  def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+    self.directory = os.path.expanduser(directory)
+    self.max_bytes = max_bytes
+    os.makedirs(self.directory, exist_ok=True)
+
+  def __key(self, uuid, format):
+    return re.sub(r'[^\w.-]', '_', f"{uuid}.{format or 'default'}")
+
+  def __data_path(self, uuid, format, version):
+    return os.path.join(self.directory, f"{self.__key(uuid, format)}.{version}.data")
+
+  def __meta_path(self, uuid, format):
+    return os.path.join(self.directory, f"{self.__key(uuid, format)}.json")
+
+  def __derived_path(self, uuid, format, version, columnar_format):
+    return os.path.join(self.directory, f"{self.__key(uuid, format)}.{version}.{columnar_format}")
+
+  # What we know about the current cached copy: its version, validators and
+  # content type. Empty if there isn't one.
+  def meta(self, uuid, format):
+    try:
+      with open(self.__meta_path(uuid, format)) as file:
+        meta = json.load(file)
+    except (OSError, ValueError):
+      return {}
+
+    if not meta.get('version') or not os.path.exists(self.__data_path(uuid, format, meta['version'])):
+      return {}
+    return meta
+
+  def validators(self, uuid, format, entry=None):
+    meta = self.meta(uuid, format) if entry is None else entry
+
+    headers = {}
+    if meta.get('etag'):
+      headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+      headers['If-Modified-Since'] = meta['last_modified']
+    return headers
+
+  # Returns an open file for the cached contents, or None if another process
+  # evicted or replaced them since we asked for validators. Holding the file
+  # open keeps the contents readable even if they go away while we're reading.
+  def open(self, uuid, format, entry=None):
+    meta = self.meta(uuid, format) if entry is None else entry
+    if not meta.get('version'):
+      return None
+
+    path = self.__data_path(uuid, format, meta['version'])
+    try:
+      file = open(path, 'rb')
+    except FileNotFoundError:
+      return None
+
+    # Eviction goes by modification time, so this marks it as recently used.
+    # If it was evicted in between, treat it as the miss it nearly was.
+    try:
+      os.utime(path)
+    except FileNotFoundError:
+      file.close()
+      return None
+    return file
+
+  # Returns the stored contents, open, along with their entry
+  def store(self, uuid, format, chunks, etag=None, last_modified=None, content_type=None):
+    version = uuid4().hex
+    data_path = self.__data_path(uuid, format, version)
+
+    # Opened before anyone else can see it, so a concurrent store cleaning up
+    # after itself can't take it away from us
+    file = None
+    def write(temp):
+      nonlocal file
+      with open(temp, 'wb') as data:
+        for chunk in chunks:
+          data.write(chunk)
+      file = open(temp, 'rb')
+      return True
+
+    try:
+      self.__replace_atomic(data_path, write)
+    except BaseException:
+      if file:
+        file.close()
+      raise
+
+    entry = dict(version=version, etag=etag, last_modified=last_modified, content_type=content_type)
+    self.__write_atomic(self.__meta_path(uuid, format), [json.dumps(entry).encode('utf-8')])
+
+    self.__remove_versions(uuid, format, keep=version)
+    self.evict(keep=data_path)
+    return file, entry
+
+  # Path to an up to date columnar copy of the dataset, or None if there isn't
+  # one yet.
+  def columnar(self, uuid, format, columnar_format, entry=None):
+    meta = self.meta(uuid, format) if entry is None else entry
+    if not meta.get('version'):
+      return None
+
+    path = self.__derived_path(uuid, format, meta['version'], columnar_format)
+    try:
+      os.utime(path)
+      os.utime(self.__data_path(uuid, format, meta['version']))
+    except FileNotFoundError:
+      # Not made yet, or evicted along with the CSV it came from
+      return None
+    return path
+
+  # Builds the columnar copy from `source`, the open cached CSV of `entry`'s
+  # version. Returns its path, or None if the CSV couldn't be converted. If a
+  # newer copy was stored meanwhile, this one is left for evict() to clear up.
+  def store_columnar(self, uuid, format, columnar_format, source, entry=None):
+    meta = self.meta(uuid, format) if entry is None else entry
+    if not meta.get('version'):
+      return None
+
+    path = self.__derived_path(uuid, format, meta['version'], columnar_format)
+    if not self.__replace_atomic(path, lambda temp: columnar.convert(source, temp, columnar_format)):
+      return None
+
+    self.evict(keep=self.__data_path(uuid, format, meta['version']))
+    return path
+
+  def __write_atomic(self, path, chunks):
+    def write(temp):
+      with open(temp, 'wb') as file:
+        for chunk in chunks:
+          file.write(chunk)
+      return True
+
+    self.__replace_atomic(path, write)
+
+  # `write` gets a temporary path in the cache directory to fill in, which is
+  # only moved to `path` if it returns True.
+  def __replace_atomic(self, path, write):
+    temp = NamedTemporaryFile(dir=self.directory, prefix='.tmp-', delete=False)
+    temp.close()
+    try:
+      if write(temp.name):
+        os.replace(temp.name, path)
+        return True
+    except BaseException:
+      self.__remove(temp.name)
+      raise
+
+    self.__remove(temp.name)
+    return False
+
+  def __remove(self, *paths):
+    for path in paths:
+      try:
+        os.unlink(path)
+      except FileNotFoundError:
+        pass
+
+  # Older copies of a dataset, and anything derived from them
+  def __remove_versions(self, uuid, format, keep):
+    prefix = f"{self.__key(uuid, format)}."
+    for entry in os.scandir(self.directory):
+      if not entry.name.startswith(prefix) or not entry.name.endswith(('.data',) + DERIVED_SUFFIXES):
+        continue
+      # <version>.<suffix>, and not some other format whose name starts the same
+      rest = entry.name[len(prefix):].split('.')
+      if len(rest) == 2 and rest[0] != keep:
+        self.__remove(entry.path)
+
+  def evict(self, keep=None):
+    stats = {}
+    for entry in os.scandir(self.directory):
+      if entry.name.endswith(('.data',) + DERIVED_SUFFIXES):
+        try:
+          stats[entry.path] = entry.stat()
+        except FileNotFoundError:
+          pass
+
+    sizes = { path: stat.st_size for path, stat in stats.items() }
+
+    # Columnar copies of a version that's gone (replaced by a newer one while
+    # they were being built) are no use to anyone
+    for path in list(sizes):
+      base, suffix = os.path.splitext(path)
+      if suffix != '.data' and base + '.data' not in sizes:
+        self.__remove(path)
+        del sizes[path]
+
+    entries = []
+    for path, stat in stats.items():
+      if path.endswith('.data'):
+        base = path[:-len('.data')]
+        derived = [base + suffix for suffix in DERIVED_SUFFIXES if base + suffix in sizes]
+        size = sizes[path] + sum(sizes[derived_path] for derived_path in derived)
+        entries.append((stat.st_mtime, size, path, derived))
+
+    total = sum(sizes.values())
+    for _, size, path, derived in sorted(entries):
+      if total <= self.max_bytes:
+        break
+      if path == keep:
+        continue
+
+      # The .json goes too, unless it's already moved on to a newer version
+      meta_path = path.rsplit('.', 2)[0] + '.json'
+      self.__remove(path, *derived)
+      self.__remove_meta(meta_path, version=path.rsplit('.', 2)[1])
+      total -= size
+
+  def __remove_meta(self, path, version):
+    try:
+      with open(path) as file:
+        if json.load(file).get('version') != version:
+          return
+    except (OSError, ValueError):
+      return
+    self.__remove(path)
+
+  def clear(self):
+    for entry in os.scandir(self.directory):
+      if entry.name.endswith(('.data', '.json') + DERIVED_SUFFIXES):
+        self.__remove(entry.path)
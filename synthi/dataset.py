@@ -1,15 +1,180 @@
 import os
 import io
-import requests
-import pandas as pd
 from typing import Dict
 
-from .common import is_uuid, gql_query, read_code
-from .api_base import OrganizationAwareAPI
+from .common import is_uuid, read_code
+from .api_base import OrganizationAwareAPI, operation, query, gather
+from .content_cache import CHUNK_SIZE
+from . import columnar
+from .formats import decoder_for, decode_csv, accept_header
+from .transfer import probe, accepts_ranges, redirect_headers, download_ranges, read_csv_parallel, ObjectChanged
+from .batch import BatchItem, chunked, batch_document, batch_variables, batch_results, DEFAULT_FILES_PER_REQUEST, DEFAULT_UPLOAD_WORKERS
+
+DATASET_META_QUERY = '''
+  query ($org: OrganizationRef, $datasetUuid: String, $datasetName: String) {
+    dataset(org: $org, uuid: $datasetUuid, name: $datasetName) {
+      id
+      name
+      uuid
+    }
+  }
+'''
+
+DATASET_LIST_QUERY = '''
+  query ($org: OrganizationRef) {
+    dataset(org: $org) {
+      id
+      name
+      uuid
+    }
+  }
+'''
+
+CREATE_DATASET_MUTATION = '''
+  mutation ($ownerId: String!, $datasetName: String, $type: DatasetType) {
+    createDataset(name: $datasetName, owner: $ownerId, type: $type) {
+      name
+      id
+      uuid
+      type
+    }
+  }
+'''
+
+UPLOAD_DATASET_MUTATION = '''
+  mutation UploadDataset($uuid: String!, $file: Upload!) {
+    updateDataset(uuid: $uuid, file: $file) {
+      id
+      uuid
+      name
+    }
+  }
+'''
+
+GENERATE_DATASET_MUTATION = '''
+  mutation GenerateDataset($uuid: String!) {
+    generateDataset(uuid: $uuid) {
+      id
+      uuid
+      name
+    }
+  }
+'''
+
+DELETE_DATASET_MUTATION = '''
+  mutation DeleteDataset($uuid: String!) {
+    deleteDataset(uuid: $uuid)
+  }
+'''
+
+SAVE_INPUT_TRANSFORMATION_MUTATION = '''
+  mutation SaveInputTransformation($uuid: String!, $code: String) {
+    saveInputTransformation(uuid: $uuid, code: $code) {
+      id
+    }
+  }
+'''
+
+TEMPLATE_TRANSFORMATION_MUTATION = '''
+  mutation TemplateTransformation($output: String!, $template: TemplateRef, $inputs: [TransformationInputMapping], $org: OrganizationRef) {
+    saveInputTransformation(
+      uuid: $output,
+      template: $template,
+      inputs: $inputs,
+      org: $org
+    ) {
+      id
+      uuid
+      name
+    }
+  }
+'''
+
+# Single fields of the documents above, repeated once per item by the *_many
+# methods. See synthi.batch.batch_document.
+DATASET_META_FIELD = 'dataset(org: $org, uuid: $datasetUuid, name: $datasetName) { id name uuid }'
+CREATE_DATASET_FIELD = 'createDataset(name: $datasetName, owner: $ownerId, type: $type) { name id uuid type }'
+DELETE_DATASET_FIELD = 'deleteDataset(uuid: $uuid)'
+UPDATE_DATASET_FIELD = 'updateDataset(uuid: $uuid, file: $file) { id uuid name }'
+
+# The document, variables and file map for one multi-file upload request
+def upload_batch(targets, files):
+  query = batch_document('mutation', dict(), dict(uuid='String!', file='Upload!'), UPDATE_DATASET_FIELD, len(targets))
+  variables = batch_variables(dict(), [dict(uuid=target.result, file=None) for target in targets])
+  uploads = { f"variables.file{i}": files[target.key] for i, target in enumerate(targets) }
+  return query, variables, uploads
+
+# Puts per-request outcomes back in the order the datasets were asked for
+def merge_batch_results(targets, outcomes):
+  outcomes = iter(outcomes)
+  return [target if target.error else next(outcomes) for target in targets]
+
+def unique_dataset(matches):
+  if len(matches) > 1:
+    raise ValueError("Couldn't find unique dataset for name or uuid")
+
+  if len(matches) > 0:
+    return matches[0]
+  else:
+    return None
+
+def meta_variables(uuid_or_name):
+  if not is_uuid(uuid_or_name):
+    return dict(datasetUuid=None, datasetName=uuid_or_name)
+  else:
+    return dict(datasetUuid=uuid_or_name, datasetName=None)
+
+# Turns an open, readable dataset body (a response stream, a cached file or an
+# in-memory buffer) into whatever get() was asked for, closing it once it has
+# been read. For chunked reads that means after the last chunk (or when the
+# iterator is thrown away), which hands any connection back to the pool.
+def read_source(source, decode=decode_csv, raw=False, as_text=True, chunksize=None, **params):
+  if raw:
+    with source:
+      content = source.read()
+    return content.decode('utf-8') if as_text else content
+  elif chunksize:
+    return iter_chunks(source, decode, chunksize=chunksize, **params)
+  else:
+    with source:
+      return decode(source, **params)
+
+def iter_chunks(source, decode, **params):
+  try:
+    for chunk in decode(source, **params):
+      yield chunk
+  finally:
+    source.close()
+
+# A streamed response body to read from. Closing it closes the response (and
+# not just its raw stream), which is what hands the connection back to the
+# pool, or drops it if the body wasn't read to the end.
+class ResponseBody(io.RawIOBase):
+  def __init__(self, response):
+    self.response = response
+
+  def readable(self):
+    return True
+
+  def readinto(self, buffer):
+    return self.response.raw.readinto(buffer)
+
+  def close(self):
+    if not self.closed:
+      self.response.close()
+    super().close()
 
 class DatasetAPI(OrganizationAwareAPI):
-  def get(self, uuid_or_name, raw=False, as_text=True, format=None):
-    uuid = self._resolve_to_uuid(uuid_or_name)
+  _kind = 'dataset'
+
+  # `filters` (row filters in pyarrow.parquet.read_table's format) can only be
+  # used along with a columnar cache, see Connection(cache_format=...).
+  #
+  # With `parallel`, large downloads are fetched as that many concurrent byte
+  # ranges when the server supports it, and CSV is parsed in as many pieces.
+  # That assumes no quoted value in the CSV spans more than one line.
+  def get(self, uuid_or_name, raw=False, as_text=True, format=None, stream=False, chunksize=None, usecols=None, dtype=None, cache=True, filters=None, parallel=None):
+    uuid = self._run(self._resolve_to_uuid(uuid_or_name))
     connection = self._connection
 
     if not uuid:
@@ -20,87 +185,157 @@ class DatasetAPI(OrganizationAwareAPI):
     if format:
       download_url = f"{download_url}?type={format}"
 
-    response = requests.get(download_url, headers=headers)
+    params = dict(chunksize=chunksize, usecols=usecols, dtype=dtype)
+    content_cache = connection.content_cache if cache else None
+    cache_format = connection.cache_format if content_cache and not raw else None
 
-    if raw:
-      if as_text:
-        return response.content.decode('utf-8')
-      else:
-        return response.content
+    if filters and not cache_format:
+      raise ValueError("Filtering rows needs a columnar cache, see Connection(cache_dir=..., cache_format=...)")
+
+    if not raw:
+      headers['Accept'] = accept_header()
+
+    # Read once, so the validators sent and the contents used on a 304 are
+    # those of the same cached copy
+    entry = content_cache.meta(uuid, format) if content_cache else {}
+    validators = content_cache.validators(uuid, format, entry) if content_cache else {}
+    if content_cache:
+      stream = True
     else:
-      return pd.read_csv(io.StringIO(response.content.decode('utf-8')))
+      # Asking for chunks only makes sense if we don't hold the whole body first
+      stream = (stream or chunksize is not None) and not raw
 
-  def meta(self, uuid_or_name):
-    datasetUuid = None
-    datasetName = None
-    
-    if not is_uuid(uuid_or_name):
-      datasetName = uuid_or_name
+    # To download in parallel we need the size up front, so start with a HEAD.
+    # If it turns out the server can't do ranges (or the cached copy is still
+    # good), this is just a cheaper version of the GET below.
+    response = None
+    if parallel and parallel > 1:
+      head = probe(connection.session, download_url, headers={ **headers, **validators }, timeout=connection.timeout)
+      if (content_cache and head.status_code == 304) or accepts_ranges(head):
+        response = head
+    ranged = response is not None and response.status_code == 200
+
+    if response is None:
+      response = connection.session.get(download_url, headers={ **headers, **validators }, timeout=connection.timeout, stream=stream)
+
+    content_type = response.headers.get('Content-Type')
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    cached = False
+
+    data = None
+    if ranged:
+      try:
+        data = download_ranges(connection.session, response.url, int(response.headers['Content-Length']), response, headers=redirect_headers(headers, response.url, download_url), parts=parallel, timeout=connection.timeout)
+      except ObjectChanged:
+        # Overwritten while we were reading it in pieces, so start over with
+        # one plain GET of whatever's there now
+        return self.get(uuid, raw=raw, as_text=as_text, format=format, stream=stream, cache=cache, filters=filters, **params)
+
+    def body():
+      return data if ranged else response.content
+
+    if content_cache and response.status_code == 304:
+      response.close()
+      source = content_cache.open(uuid, format, entry)
+      if not source:
+        # Another process evicted it since we asked, so download it again. It
+        # goes back in the cache, which any filters need to be read from.
+        return self.get(uuid, raw=raw, as_text=as_text, format=format, stream=stream, cache=cache, filters=filters, parallel=parallel, **params)
+      content_type = entry.get('content_type')
+      cached = True
+    elif content_cache and response.status_code == 200 and (etag or last_modified):
+      with response:
+        chunks = [body()] if ranged else response.iter_content(CHUNK_SIZE)
+        source, entry = content_cache.store(uuid, format, chunks, etag=etag, last_modified=last_modified, content_type=content_type)
+      cached = True
+    elif stream and not raw and not ranged:
+      # The body is decoded straight from the socket (undoing any gzip/zstd
+      # transfer compression on the way), so only the decoder's own buffers
+      # and the resulting frame(s) are ever in memory.
+      response.raw.decode_content = True
+      source = io.BufferedReader(ResponseBody(response), CHUNK_SIZE)
     else:
-      datasetUuid = uuid_or_name
-
-    query = '''
-    query ($org: OrganizationRef, $datasetUuid: String, $datasetName: String) {
-      dataset(org: $org, uuid: $datasetUuid, name: $datasetName) {
-        id
-        name
-        uuid
-      }
-    }
-    '''
+      data = body()
+      if ranged and not raw and not chunksize and not filters and decoder_for(content_type, format) is decode_csv:
+        return read_csv_parallel(data, workers=parallel, usecols=usecols, dtype=dtype)
+      source = io.BytesIO(data)
+
+    decode = decoder_for(content_type, format)
+
+    # Only CSV gets a columnar copy, anything else is already in a format that
+    # is quick to read
+    if cached and cache_format and decode is decode_csv:
+      return self.__read_columnar(source, uuid, format, cache_format, entry, filters=filters, **params)
+    elif filters:
+      source.close()
+      raise ValueError("Filtering rows only works on cached CSV datasets")
+
+    return read_source(source, decode, raw=raw, as_text=as_text, **params)
+
+  # Reads from the columnar copy of a cached dataset, creating it from the
+  # cached CSV in `source` first if need be.
+  def __read_columnar(self, source, uuid, format, cache_format, entry, filters=None, **params):
+    content_cache = self._connection.content_cache
+
+    path = content_cache.columnar(uuid, format, cache_format, entry)
+    if not path:
+      path = content_cache.store_columnar(uuid, format, cache_format, source, entry)
+
+    if not path and not filters:
+      source.seek(0)
+      return read_source(source, decode_csv, **params)
 
+    source.close()
+    if not path:
+      raise ValueError(f"Couldn't build a columnar copy of {uuid} to filter")
+
+    return columnar.read(path, cache_format, filters=filters, **params)
+
+  @operation
+  def meta(self, uuid_or_name):
     variables = dict(
-      org = self._default_organization(),
-      datasetUuid = datasetUuid,
-      datasetName = datasetName
+      org = (yield from self._default_organization()),
+      **meta_variables(uuid_or_name)
     )
 
-    results = gql_query(query, variables=variables, connection=self._connection)
-    
-    if len(results['dataset']) > 1:
-      raise ValueError("Couldn't find unique dataset for name or uuid")
+    results = yield query(DATASET_META_QUERY, variables=variables)
 
-    if len(results['dataset']) > 0:
-      return results['dataset'][0]
-    else:
-      return None
+    return unique_dataset(results['dataset'])
 
+  @operation
+  def meta_many(self, uuids_or_names, batch_size=None):
+    results = yield from self._batch(
+      'query', dict(org='OrganizationRef'), dict(datasetUuid='String', datasetName='String'),
+      DATASET_META_FIELD, uuids_or_names,
+      shared=dict(org=(yield from self._default_organization())),
+      items=[meta_variables(uuid_or_name) for uuid_or_name in uuids_or_names],
+      convert=unique_dataset,
+      batch_size=batch_size
+    )
+
+    for item in results:
+      yield from self._remember(item.result)
+
+    return results
+
+  @operation
   def list(self):
-    query = '''
-    query ($org: OrganizationRef) {
-      dataset(org: $org) {
-        id
-        name
-        uuid
-      }
-    }
-    '''
-    
     variables = dict(
-      org = self._default_organization()
+      org = (yield from self._default_organization())
     )
     
-    results = gql_query(query, variables=variables, connection=self._connection)
+    results = yield query(DATASET_LIST_QUERY, variables=variables)
 
     return results['dataset']
 
+  @operation
   def create(self, name=None, type=None):
     valid_name = ((not name) or (isinstance(name, str) and not is_uuid(name)))
     assert valid_name, f"{name} is not a valid name"
 
-    query = '''
-    mutation ($ownerId: String!, $datasetName: String, $type: DatasetType) {
-      createDataset(name: $datasetName, owner: $ownerId, type: $type) {
-        name
-        id
-        uuid
-        type
-      }
-    }
-    '''
-    
     variables = dict(
-      ownerId = self._default_organization()['uuid'],
+      ownerId = (yield from self._default_organization())['uuid'],
       datasetName = name,
       type = type
     )
@@ -108,70 +343,130 @@ class DatasetAPI(OrganizationAwareAPI):
     if type:
       variables['type'] = type
     
-    result = gql_query(query, variables=variables, connection=self._connection)
+    result = yield query(CREATE_DATASET_MUTATION, variables=variables)
+    yield from self._remember(result['createDataset'])
     
     return result['createDataset']
 
-  def upload(self, uuid_or_name, file, type=None):
-    uuid = self.__ensure_dataset(uuid_or_name, type=type)
-    
-    query = '''
-    mutation UploadDataset($uuid: String!, $file: Upload!) {
-      updateDataset(uuid: $uuid, file: $file) {
-        id
-        uuid
-        name
-      }
-    }
-    '''
+  @operation
+  def create_many(self, names, type=None, batch_size=None):
+    for name in names:
+      assert isinstance(name, str) and not is_uuid(name), f"{name} is not a valid name"
+
+    results = yield from self._batch(
+      'mutation', dict(ownerId='String!', type='DatasetType'), dict(datasetName='String'),
+      CREATE_DATASET_FIELD, names,
+      shared=dict(ownerId=(yield from self._default_organization())['uuid'], type=type),
+      items=[dict(datasetName=name) for name in names],
+      batch_size=batch_size
+    )
+
+    for item in results:
+      yield from self._remember(item.result)
+
+    return results
+
+  # `file` can be a path, a file-like object or a DataFrame. `progress` is
+  # called with (bytes_sent, total_bytes) while the upload is going, where
+  # total_bytes is None if the size isn't known up front.
+  @operation
+  def upload(self, uuid_or_name, file, type=None, progress=None):
+    uuid = yield from self.__ensure_dataset(uuid_or_name, type=type)
     
     variables = dict(
       uuid = uuid,
       file = 'null' # this is important for the graphql upload standard
     )
 
-    result = gql_query(query, variables=variables, file=file, connection=self._connection)
+    result = yield query(UPLOAD_DATASET_MUTATION, variables=variables, file=file, progress=progress)
     
     return result['updateDataset']
 
+  # Uploads many files at once. `files` maps dataset names (or uuids) to
+  # anything upload() accepts, and datasets that don't exist yet get created.
+  # Up to `files_per_request` files are sent in each multipart request, with
+  # `workers` requests going in parallel. Keep the connection's pool_size at
+  # least as large as `workers`, or the extra threads will just wait on it.
+  # The async client ignores `workers`: it sends every request at once, as
+  # many at a time as its limiter lets through.
+  @operation
+  def upload_many(self, files, type=None, files_per_request=DEFAULT_FILES_PER_REQUEST, workers=DEFAULT_UPLOAD_WORKERS, batch_size=None):
+    files = dict(files)
+    targets = yield from self.__ensure_many(list(files), type=type, batch_size=batch_size)
+
+    ready = [target for target in targets if not target.error]
+    chunks = list(chunked(ready, files_per_request))
+    requests = []
+    for chunk in chunks:
+      document, variables, uploads = upload_batch(chunk, files)
+      requests.append(query(document, variables=variables, files=uploads, partial=True))
+
+    # One failed request shouldn't lose the results of all the others
+    outcomes = []
+    for chunk, result in zip(chunks, (yield gather(requests, workers=workers, errors=True))):
+      if isinstance(result, Exception):
+        outcomes += [BatchItem(target.key, None, result) for target in chunk]
+      else:
+        data, errors = result
+        outcomes += batch_results([target.key for target in chunk], data, errors)
+
+    return merge_batch_results(targets, outcomes)
+
+  @operation
   def define(self, uuid_or_name, path=None, code=None, template:str = None, inputs:Dict[str,str] = {}, type='csv'):
     if (path or code) and not (template or inputs):
-      return self.__create_basic_transformation(uuid_or_name, path, code, type=type)
+      return (yield from self.__create_basic_transformation(uuid_or_name, path, code, type=type))
     elif (template and inputs):
-      return self.__create_transformation_ref(uuid_or_name, template, inputs, type=type)
+      return (yield from self.__create_transformation_ref(uuid_or_name, template, inputs, type=type))
 
     raise Exception("Must provide code, a path, or a transformation template name and inputs")
 
+  @operation
   def generate(self, uuid_or_name):    
-    uuid = self.__ensure_dataset(uuid_or_name)
-
-    query = '''
-    mutation GenerateDataset($uuid: String!) {
-      generateDataset(uuid: $uuid) {
-        id
-        uuid
-        name
-      }
-    }
-    '''
-    result = gql_query(query, variables={'uuid':uuid}, connection=self._connection)
+    uuid = yield from self.__ensure_dataset(uuid_or_name)
+
+    result = yield query(GENERATE_DATASET_MUTATION, variables={'uuid':uuid})
     
     return result['generateDataset']
 
+  @operation
   def delete(self, uuid_or_name):
-    uuid = self._resolve_to_uuid(uuid_or_name)
+    uuid = yield from self._resolve_to_uuid(uuid_or_name)
     if not uuid:
       raise ValueError("Can't find the dataset to delete")
 
-    query = '''
-    mutation DeleteDataset($uuid: String!) {
-      deleteDataset(uuid: $uuid)
-    }
-    '''
-    result = gql_query(query, variables={'uuid':uuid}, connection=self._connection)
+    result = yield query(DELETE_DATASET_MUTATION, variables={'uuid':uuid})
+    self._forget(uuid=uuid)
     
     return result['deleteDataset']
 
+  @operation
+  def delete_many(self, uuids_or_names, batch_size=None):
+    resolved = yield from self.__resolve_many(uuids_or_names, batch_size=batch_size)
+    found = [item for item in resolved if item.result]
+
+    deleted = iter((yield from self._batch(
+      'mutation', dict(), dict(uuid='String!'),
+      DELETE_DATASET_FIELD, [item.key for item in found],
+      shared=dict(),
+      items=[dict(uuid=item.result) for item in found],
+      batch_size=batch_size
+    )))
+
+    results = []
+    for item in resolved:
+      if item.error:
+        results.append(item)
+      elif not item.result:
+        results.append(BatchItem(item.key, None, ValueError("Can't find the dataset to delete")))
+      else:
+        outcome = next(deleted)
+        if not outcome.error:
+          self._forget(uuid=item.result)
+        results.append(outcome)
+
+    return results
+
   def __create_basic_transformation(self, uuid_or_name, path=None, code=None, type='csv'):
     if not path and not code:
       raise ValueError("Need to either give a path to a transformation code file or the code itself")
@@ -179,57 +474,73 @@ class DatasetAPI(OrganizationAwareAPI):
     if path and code:
       raise ValueError("Give either a path to a transformation code file or code, not both")
       
-    uuid = self.__ensure_dataset(uuid_or_name, type=type)
+    uuid = yield from self.__ensure_dataset(uuid_or_name, type=type)
     code = read_code(path)
       
-    query = '''
-    mutation SaveInputTransformation($uuid: String!, $code: String) {
-      saveInputTransformation(uuid: $uuid, code: $code) {
-        id
-      }
-    }
-    '''
-
     variables = dict(
       uuid = uuid,
       code = code
     )
     
-    result = gql_query(query, variables=variables, connection=self._connection)
+    result = yield query(SAVE_INPUT_TRANSFORMATION_MUTATION, variables=variables)
     
     return result['saveInputTransformation']
 
   def __create_transformation_ref(self, uuid_or_name, template:str, inputs:Dict[str,str], type='csv'):
-    query = '''
-      mutation TemplateTransformation($output: String!, $template: TemplateRef, $inputs: [TransformationInputMapping], $org: OrganizationRef) {
-        saveInputTransformation(
-          uuid: $output,
-          template: $template,
-          inputs: $inputs,
-          org: $org
-        ) {
-          id
-          uuid
-          name
-        }
-      }
-    '''
-
     variables = dict(
-      output   = self.__ensure_dataset(uuid_or_name, type=type),
+      output   = (yield from self.__ensure_dataset(uuid_or_name, type=type)),
       template = dict(name=template),
       inputs   = [dict(alias=k, dataset=dict(name=v)) for k,v in inputs.items()],
-      org      = self._default_organization(),
+      org      = (yield from self._default_organization()),
     )
 
-    result = gql_query(query, variables=variables, connection=self._connection)
+    result = yield query(TEMPLATE_TRANSFORMATION_MUTATION, variables=variables)
 
     return result['saveInputTransformation']
 
+  # Like _resolve_to_uuid, but any names that aren't already cached get looked
+  # up together through meta_many.
+  def __resolve_many(self, uuids_or_names, batch_size=None):
+    cache = self._connection.resolution_cache
+    org = (yield from self._default_organization())['uuid']
+
+    resolved = {}
+    unresolved = []
+    for uuid_or_name in uuids_or_names:
+      uuid = uuid_or_name if is_uuid(uuid_or_name) else cache.get(org, self._kind, uuid_or_name)
+      if uuid:
+        resolved[uuid_or_name] = BatchItem(uuid_or_name, uuid, None)
+      elif uuid_or_name not in unresolved:
+        unresolved.append(uuid_or_name)
+
+    if unresolved:
+      for item in (yield from self.meta_many.steps(unresolved, batch_size=batch_size)):
+        resolved[item.key] = BatchItem(item.key, item.result and item.result['uuid'], item.error)
+
+    return [resolved[uuid_or_name] for uuid_or_name in uuids_or_names]
+
+  def __ensure_many(self, uuids_or_names, type='csv', batch_size=None):
+    resolved = yield from self.__resolve_many(uuids_or_names, batch_size=batch_size)
+    missing = [item.key for item in resolved if not item.result and not item.error and not is_uuid(item.key)]
+
+    created = {}
+    if missing:
+      for item in (yield from self.create_many.steps(missing, type=type, batch_size=batch_size)):
+        created[item.key] = BatchItem(item.key, item.result and item.result['uuid'], item.error)
+
+    ensured = []
+    for item in resolved:
+      item = created.get(item.key, item)
+      if not item.result and not item.error:
+        item = BatchItem(item.key, None, ValueError(f"Dataset not found for {item.key}"))
+      ensured.append(item)
+
+    return ensured
+
   def __ensure_dataset(self, uuid_or_name, type='csv'):
-    uuid = self._resolve_to_uuid(uuid_or_name)
+    uuid = yield from self._resolve_to_uuid(uuid_or_name)
     if not uuid and (not uuid_or_name or isinstance(uuid_or_name, str)):
-      info = self.create(uuid_or_name, type=type)
+      info = yield from self.create.steps(uuid_or_name, type=type)
       uuid = info['uuid']
 
     return uuid
@@ -0,0 +1,91 @@
+import pickle
+import multiprocessing
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from concurrent.futures import Future, ProcessPoolExecutor
+
+# Transform functions are usually defined in a transformation script that's
+# loaded by path, and the @transformation decorator replaces them with a
+# Transformation object anyway, so they can't be pickled over to another
+# process. Instead, the function is set here before the workers get forked
+# and they find it already in place.
+__transform = None
+
+def run_transform(*args):
+  return __transform(*args)
+
+# Pickling with protocol 5 hands us the large buffers (a DataFrame's column
+# data) separately from the rest, so only those go into a shared memory block
+# the other side can copy straight out of, instead of everything being pickled
+# into one big bytes object and pushed through a pipe.
+def pack(obj):
+  buffers = []
+  payload = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+  if not buffers:
+    return payload, None, []
+
+  raw = [buffer.raw() for buffer in buffers]
+  block = SharedMemory(create=True, size=max(1, sum(view.nbytes for view in raw)))
+  spans = []
+  offset = 0
+  for view in raw:
+    block.buf[offset:offset + view.nbytes] = view
+    spans.append((offset, view.nbytes))
+    offset += view.nbytes
+  block.close()
+
+  return payload, block.name, spans
+
+# Whoever unpacks is done with the block, so it gets removed here
+def unpack(packed):
+  payload, name, spans = packed
+  if name is None:
+    return pickle.loads(payload)
+
+  block = SharedMemory(name=name)
+  try:
+    data = bytearray(block.buf[:sum(size for _, size in spans)])
+  finally:
+    block.close()
+    block.unlink()
+
+  view = memoryview(data)
+  return pickle.loads(payload, buffers=[view[offset:offset + size] for offset, size in spans])
+
+def call_packed(fn, packed):
+  return pack(fn(*unpack(packed)))
+
+class SharedMemoryExecutor(ProcessPoolExecutor):
+  def submit(self, fn, *args):
+    future = Future()
+
+    # The result is unpacked even if nobody wants it anymore, so that its
+    # shared memory gets cleaned up
+    def done(packed_future):
+      try:
+        result = unpack(packed_future.result())
+      except BaseException as e:
+        if not future.cancelled():
+          future.set_exception(e)
+      else:
+        if not future.cancelled():
+          future.set_result(result)
+
+    super().submit(call_packed, fn, pack(args)).add_done_callback(done)
+    return future
+
+# Submit run_transform to the returned executor to have `transform` called in
+# one of `processes` worker processes.
+def process_pool(transform, processes):
+  global __transform
+  __transform = transform
+
+  # Workers have to be forked (not spawned) to inherit __transform. Starting
+  # them all up front also gets that done before any other threads exist, and
+  # the shared resource tracker means blocks created by one process and
+  # unlinked by another are still accounted for.
+  resource_tracker.ensure_running()
+  executor = SharedMemoryExecutor(max_workers=processes, mp_context=multiprocessing.get_context('fork'))
+  ProcessPoolExecutor.submit(executor, int).result()
+
+  return executor
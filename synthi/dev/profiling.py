@@ -0,0 +1,232 @@
+import math
+import numpy as np
+import pandas as pd
+
+# 2^14 registers gives distinct counts within about 1% using 16KB per column
+HLL_PRECISION = 14
+
+# Synthi tags by numpy's dtype kind, which pandas' extension dtypes (nullable
+# Int64/Float64/boolean, pyarrow backed types) fill in the same way. Dates,
+# times, text and anything else without a tag of its own are Strings.
+KIND_TAGS = {
+  'i': 'Integer',
+  'u': 'Integer',
+  'f': 'Float',
+  'b': 'Boolean',
+}
+
+# Leading zeros (plus one) of every 16 bit number
+LEADING_ZEROS = np.array([17] + [17 - i.bit_length() for i in range(1, 1 << 16)], dtype=np.uint8)
+
+def dtype_tag(dtype):
+  dtype = pd.api.types.pandas_dtype(dtype)
+  if isinstance(dtype, pd.CategoricalDtype):
+    return dtype_tag(dtype.categories.dtype) if dtype.categories is not None else 'String'
+  if isinstance(dtype, pd.SparseDtype):
+    return dtype_tag(dtype.subtype)
+  return KIND_TAGS.get(dtype.kind, 'String')
+
+# Tags a column can be promoted through as later chunks disagree with earlier
+# ones. Anything that can't be reconciled ends up a String.
+TAG_PROMOTIONS = {
+  ('Integer', 'Float'): 'Float',
+  ('Float', 'Integer'): 'Float',
+}
+
+def promote(tag, other):
+  if tag is None or tag == other:
+    return other
+  return TAG_PROMOTIONS.get((tag, other), 'String')
+
+# Approximate distinct counting in constant memory. Values are hashed (by
+# pandas, vectorized) to 64 bits: the first `precision` bits pick a register and
+# each register keeps the longest run of leading zeros seen in the rest.
+class HyperLogLog:
+  def __init__(self, precision=HLL_PRECISION):
+    self.precision = precision
+    self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+  def update(self, series):
+    values = series.dropna()
+    if values.empty:
+      return
+
+    hashes = pd.util.hash_pandas_object(values, index=False).to_numpy(dtype=np.uint64)
+    index = hashes >> np.uint64(64 - self.precision)
+    # The low bit set makes sure there's always a 1 to find
+    rest = (hashes << np.uint64(self.precision)) | np.uint64(1 << (self.precision - 1))
+
+    # Almost every hash has a 1 somewhere in its top 16 bits, so the leading
+    # zeros can be looked up. The odd one out gets counted the slow way.
+    top = (rest >> np.uint64(48)).astype(np.uint16)
+    rank = LEADING_ZEROS[top]
+    zero = top == 0
+    if zero.any():
+      rank[zero] = (64 - np.floor(np.log2(rest[zero].astype(np.float64)))).astype(np.uint8)
+
+    np.maximum.at(self.registers, index, rank)
+
+  def count(self):
+    size = len(self.registers)
+    alpha = 0.7213 / (1 + 1.079 / size)
+    estimate = alpha * size * size / np.sum(np.power(2.0, -self.registers.astype(np.float64)))
+
+    # Small cardinalities are better served by counting empty registers
+    empty = np.count_nonzero(self.registers == 0)
+    if estimate <= 2.5 * size and empty:
+      estimate = size * math.log(size / empty)
+
+    return int(round(estimate))
+
+# Everything we keep track of for one column across all of the chunks
+class ColumnProfile:
+  def __init__(self, name, order):
+    self.name = name
+    self.order = order
+    self.tag = None
+    self.nulls = 0
+    self.min = None
+    self.max = None
+    self.comparable = True
+    self.distinct = HyperLogLog()
+
+  def update(self, series):
+    nulls = int(series.isna().sum())
+    self.nulls += nulls
+
+    # An all empty chunk says nothing about what type the column really is
+    # (pandas will just call it float64)
+    if nulls == len(series):
+      return
+
+    tag = promote(self.tag, dtype_tag(series.dtype))
+    if self.tag and tag != self.tag and tag == 'String':
+      # Numbers earlier on and strings now, so min/max doesn't mean anything
+      self.comparable = False
+    self.tag = tag
+
+    if self.comparable:
+      try:
+        low, high = series.min(), series.max()
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+      except TypeError:
+        self.comparable = False
+
+    self.distinct.update(series)
+
+  def stats(self):
+    return dict(
+      nulls = self.nulls,
+      min = plain(self.min) if self.comparable else None,
+      max = plain(self.max) if self.comparable else None,
+      distinct = self.distinct.count()
+    )
+
+# Builds up column metadata over a whole stream of DataFrames one chunk at a
+# time, so it only ever holds on to a fixed amount per column no matter how
+# long the stream is.
+class Profile:
+  def __init__(self):
+    self.rows = 0
+    self.columns = dict()
+
+  def update(self, df):
+    self.rows += len(df)
+    for name in df.columns:
+      if name not in self.columns:
+        self.columns[name] = ColumnProfile(name, len(self.columns) + 1)
+      self.columns[name].update(df[name])
+
+  def record(self, metadata):
+    metadata['columns'] = [
+      dict(
+        name=column.name,
+        originalName=column.name,
+        tags=[column.tag or 'String'],
+        order=column.order
+      ) for column in self.columns.values()
+    ]
+    metadata['type'] = 'csv'
+    metadata['profile'] = dict(
+      rows = self.rows,
+      columns = { column.name: column.stats() for column in self.columns.values() }
+    )
+
+# Keeps a uniform random sample of `size` rows from a stream of DataFrames
+# without knowing how long it's going to be, using Algorithm L: rather than
+# drawing a random number for every row, it works out how many rows to skip
+# until the next one that goes into the sample. That's O(size * log(rows /
+# size)) random draws overall, and skipped rows are never even looked at.
+class Reservoir:
+  def __init__(self, size, seed=None):
+    self.size = size
+    self.random = np.random.default_rng(seed)
+    self.rows = None
+    self.seen = 0
+    self.next = None
+    self.w = None
+
+  def update(self, df):
+    if not self.size or df.empty:
+      self.seen += len(df)
+      return
+
+    offset = self.seen
+    self.seen += len(df)
+
+    # Until the reservoir is full, every row goes in
+    start = 0
+    if self.rows is None or len(self.rows) < self.size:
+      missing = self.size - (0 if self.rows is None else len(self.rows))
+      start = min(missing, len(df))
+      self.__add(df.iloc[:start])
+      if len(self.rows) < self.size:
+        return
+      self.w = math.exp(math.log(self.__uniform()) / self.size)
+      self.__skip(offset + start - 1)
+
+    # Which slot each picked row replaces. A later pick from the same chunk
+    # can land on a slot an earlier one already took, in which case the later
+    # one wins, just as if they'd been replaced one at a time.
+    replacements = dict()
+    while self.next < self.seen:
+      replacements[int(self.random.integers(self.size))] = self.next - offset
+      self.w *= math.exp(math.log(self.__uniform()) / self.size)
+      self.__skip(self.next)
+
+    if replacements:
+      keep = np.ones(self.size, dtype=bool)
+      keep[list(replacements)] = False
+      self.rows = pd.concat([self.rows[keep], df.iloc[list(replacements.values())]])
+
+  def sample(self):
+    return self.rows.reset_index(drop=True) if self.rows is not None else pd.DataFrame()
+
+  def __add(self, rows):
+    self.rows = rows if self.rows is None else pd.concat([self.rows, rows])
+
+  def __skip(self, position):
+    self.next = position + int(math.floor(math.log(self.__uniform()) / math.log(1 - self.w))) + 1
+
+  # Strictly between 0 and 1, so there's always a logarithm to take
+  def __uniform(self):
+    return self.random.uniform(np.nextafter(0, 1), 1)
+
+# Picks `size` rows at random without shuffling (or even looking at) the
+# rest of the frame the way DataFrame.sample does.
+def sample_rows(df, size, seed=None):
+  size = min(size, len(df))
+  positions = np.random.default_rng(seed).choice(len(df), size=size, replace=False)
+  return df.take(positions)
+
+# numpy/pandas scalars become plain python values so that metadata can go
+# straight to JSON
+def plain(value):
+  if value is None:
+    return None
+  if isinstance(value, np.generic):
+    return value.item()
+  if isinstance(value, (int, float, str, bool)):
+    return value
+  return str(value)
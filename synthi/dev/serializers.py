@@ -0,0 +1,153 @@
+import asyncio
+
+from ..columnar import pyarrow
+from ..formats import is_frame
+from . import storage
+
+# Rows per Parquet row group / Arrow record batch when writing a whole
+# DataFrame, so that it's encoded and sent a piece at a time
+FRAME_CHUNK_ROWS = 64 * 1024
+
+# Serializers write a transformation's result to storage in the output's
+# format. Each format has one for a whole DataFrame (`write(df, url)`) and one
+# for a stream of them (`write_stream(dfs, url)`, async). Both return a
+# storage.manifest. Anything that isn't a DataFrame (bytes, text) is written
+# as is, whatever the format says.
+SERIALIZERS = {}
+
+def register_serializer(formats, write, write_stream):
+  for format in formats:
+    SERIALIZERS[format] = (write, write_stream)
+
+def serializer_for(format):
+  # CSV is what Synthi expects unless told otherwise
+  return SERIALIZERS.get(format) or SERIALIZERS['csv']
+
+def write(data, format, url):
+  if is_frame(data):
+    write_frame, _ = serializer_for(format)
+    return write_frame(data, url)
+  return storage.write_raw(data, url)
+
+async def write_stream(data, format, url):
+  first, data = await peek(data)
+  if first is None or is_frame(first):
+    _, write_frames = serializer_for(format)
+    return await write_frames(data, url)
+  return await storage.write_raw_stream(data, url)
+
+# Takes the first item off an async iterator to see what's in it, and hands
+# back an iterator that still starts with it
+async def peek(items):
+  items = items.__aiter__()
+  try:
+    first = await items.__anext__()
+  except StopAsyncIteration:
+    first = None
+
+  async def rest():
+    if first is None:
+      return
+    yield first
+    async for item in items:
+      yield item
+
+  return first, rest()
+
+# A write-only file for pyarrow's writers, which gives back whatever's been
+# written to it since the last time we asked. That lets us send each row group
+# or record batch as soon as it's encoded.
+class Drain:
+  def __init__(self):
+    self.parts = []
+    self.position = 0
+    self.closed = False
+
+  def write(self, data):
+    self.parts.append(bytes(data))
+    self.position += len(data)
+    return len(data)
+
+  def tell(self):
+    return self.position
+
+  def flush(self):
+    pass
+
+  def close(self):
+    self.closed = True
+
+  def take(self):
+    data = b''.join(self.parts)
+    self.parts = []
+    return data
+
+# Encodes frames with a pyarrow writer from `open_writer(sink, schema)`, one
+# row group / record batch per frame. The schema comes from the first frame and
+# later ones are cast to it.
+class FrameEncoder:
+  def __init__(self, open_writer):
+    self.open_writer = open_writer
+    self.sink = Drain()
+    self.writer = None
+    self.schema = None
+
+  def encode(self, df):
+    table = pyarrow().Table.from_pandas(df, preserve_index=False)
+    if self.writer is None:
+      self.schema = table.schema
+      self.writer = self.open_writer(self.sink, self.schema)
+    elif table.schema != self.schema:
+      table = table.cast(self.schema)
+
+    self.writer.write_table(table)
+    return self.sink.take()
+
+  def finish(self, schema=None):
+    if self.writer is None:
+      # Nothing came through, but it should still be a valid (empty) file
+      self.writer = self.open_writer(self.sink, schema or pyarrow().schema([]))
+    self.writer.close()
+    return self.sink.take()
+
+def columnar_serializer(open_writer):
+  def write_frame(df, url):
+    def chunks():
+      encoder = FrameEncoder(open_writer)
+      for start in range(0, len(df), FRAME_CHUNK_ROWS):
+        yield encoder.encode(df.iloc[start:start + FRAME_CHUNK_ROWS])
+      yield encoder.finish(pyarrow().Schema.from_pandas(df, preserve_index=False))
+
+    return storage.write_chunks(chunks, url, rows=len(df))
+
+  async def write_frames(dfs, url):
+    loop = asyncio.get_running_loop()
+    encoder = FrameEncoder(open_writer)
+    rows = 0
+
+    async def chunks():
+      nonlocal rows
+      async for df in dfs:
+        rows += len(df)
+        # Off the event loop, so encoding overlaps with sending earlier chunks
+        yield await loop.run_in_executor(None, encoder.encode, df)
+      yield encoder.finish()
+
+    return { **(await storage.write_raw_stream(chunks(), url)), 'rows': rows }
+
+  return write_frame, write_frames
+
+def open_parquet(sink, schema):
+  from pyarrow import parquet
+  return parquet.ParquetWriter(sink, schema)
+
+def open_arrow_file(sink, schema):
+  return pyarrow().ipc.new_file(sink, schema)
+
+def open_arrow_stream(sink, schema):
+  return pyarrow().ipc.new_stream(sink, schema)
+
+register_serializer(['csv'], storage.write_csv, storage.write_csv_stream)
+register_serializer(['parquet'], *columnar_serializer(open_parquet))
+register_serializer(['arrow', 'feather'], *columnar_serializer(open_arrow_file))
+register_serializer(['arrow-stream'], *columnar_serializer(open_arrow_stream))
@@ -1,79 +1,532 @@
-import httpx
 import asyncio
+import builtins
+import os
+import sys
+import hashlib
+import base64
+import io
+import re
+import time
+import requests
+import csv
+import itertools
+from collections import OrderedDict
+from threading import Lock
+from urllib.parse import urlparse
 from importlib.util import spec_from_file_location, module_from_spec
 from tempfile import NamedTemporaryFile
 from io import BytesIO
-from magic import Magic
-import requests
-import pandas as pd
 
-magic = Magic(mime_encoding=True)
+from ..common import create_session, DEFAULT_POOL_SIZE, DEFAULT_RETRIES, DEFAULT_BACKOFF_FACTOR, DEFAULT_TIMEOUT
+from ..formats import FORMAT_DECODERS
+from ..multipart import iter_csv_chunks, CSV_CHUNK_ROWS
+from ..transfer import probe, accepts_ranges, download_ranges, read_csv_parallel, ObjectChanged
 
-def read_raw(url, chunksize=None):
-  res = requests.get(url, stream=(chunksize != None))
-  if res.status_code != 200:
-    raise Exception(f"Failed to read dataset {url} got {res.status_code}")
+# How much of a CSV file to sniff its encoding from, starting small and
+# growing while it looks like plain ASCII (up to the max)
+SNIFF_WINDOW = 64*1024
+MAX_SNIFF_WINDOW = 1024*1024
+SNIFF_DELIMITERS = ',;\t|'
+SNIFF_CACHE_SIZE = 256
+
+# What libmagic calls some encodings, in a way python understands. ASCII is
+# read as UTF-8 in case anything else turns up past the sniffed part, and
+# 8 bit text libmagic can't place at least reads as Latin-1 without errors.
+SNIFFED_ENCODINGS = {
+  'us-ascii': 'utf-8',
+  'unknown-8bit': 'latin-1',
+  'binary': None,
+}
+
+READ_CHUNK_SIZE = 1024*1024
+
+# Files transformation scripts get loaded from start with this
+SCRIPT_PREFIX = 'synthi_script_'
+
+# Failures worth picking a transfer back up after, as opposed to the server
+# telling us no
+TRANSIENT_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout)
+
+class StorageError(Exception):
+  def __init__(self, message, url=None, status=None):
+    super().__init__(message)
+    self.url = url
+    self.status = status
+
+# Storage URLs are pre-signed, so there's no Connection around to borrow a
+# session from. Instead, all synchronous storage calls share a module level
+# pooled session that can be tuned via configure().
+#
+# `retries` also covers reads that break off partway through: those pick up
+# again from the last byte received rather than starting over.
+__session = None
+__timeout = DEFAULT_TIMEOUT
+__retries = DEFAULT_RETRIES
+__backoff_factor = DEFAULT_BACKOFF_FACTOR
+
+# Sniffed read_csv params (and whether they were conclusive) by (object path,
+# ETag), so the same unchanged dataset only ever gets sniffed once
+__sniffed = OrderedDict()
+__sniffed_lock = Lock()
+
+# libmagic loads its whole database when it's opened, so that waits until
+# there's actually something to sniff
+__magic = None
+
+def configure(pool_size=DEFAULT_POOL_SIZE, retries=DEFAULT_RETRIES, backoff_factor=DEFAULT_BACKOFF_FACTOR, timeout=DEFAULT_TIMEOUT):
+  global __session, __timeout, __retries, __backoff_factor
+  if __session:
+    __session.close()
+  __session = create_session(pool_size=pool_size, retries=retries, backoff_factor=backoff_factor)
+  __timeout = timeout
+  __retries = retries
+  __backoff_factor = backoff_factor
+
+def session():
+  if not __session:
+    configure()
+  return __session
+
+def magic():
+  global __magic
+  if not __magic:
+    from magic import Magic
+    __magic = Magic(mime_encoding=True)
+  return __magic
+
+# With `parallel`, a big enough object is fetched as that many concurrent byte
+# ranges, if the storage server supports them (Swift and S3 both do).
+def read_raw(url, chunksize=None, parallel=None):
+  if parallel and parallel > 1 and not chunksize:
+    data = __read_ranges(url, parallel)
+    if data is not None:
+      return data
+
+  chunks = __iter_resumable(url, chunksize or READ_CHUNK_SIZE)
   if chunksize:
-    return res.iter_content(chunk_size=chunksize)
+    return chunks
   else:
-    return res.content
+    return b''.join(chunks)
 
-def read_csv(url, params={}, detectEncoding=False, chunksize=None):
-  encoding = None
-  if detectEncoding:
-    # guess the encoding from up to the first 10MB of the file
-    checkbytes = 1024*1024*10
-    headers = {"Range": f"bytes=0-{checkbytes}"}
-    res = requests.get(url, headers=headers)
-    encoding = magic.from_buffer(res.content)
-
-  params = { 'encoding': encoding, **params }
+# `parallel` works as in read_raw(), and then also parses the CSV in that many
+# pieces. That assumes no quoted value spans more than one line.
+#
+# With `detectEncoding`, the encoding and CSV dialect are sniffed from the
+# start of the same download that then gets parsed (see sniff_csv()).
+# Anything set in `params` wins over what was detected.
+def read_csv(url, params={}, detectEncoding=False, chunksize=None, parallel=None):
+  params = dict(params)
 
   if chunksize:
     params['chunksize'] = chunksize
+  elif parallel and parallel > 1:
+    data = __read_ranges(url, parallel)
+    if data is not None:
+      if detectEncoding:
+        params = { **__sniff_buffer(url, data), **params }
+      return read_csv_parallel(data, workers=parallel, **params)
+
+  import pandas as pd
+
+  response_headers = requests.structures.CaseInsensitiveDict()
+  chunks = __iter_resumable(url, response_headers=response_headers)
+  conclusive = True
+  if detectEncoding:
+    sniffed, conclusive, chunks = __sniff_stream(url, chunks, response_headers)
+    conclusive = conclusive or 'encoding' in params
+    params = { **sniffed, **params }
 
-  return pd.read_csv(url, **params)
+  try:
+    return pd.read_csv(io.BufferedReader(ChunkStream(chunks), READ_CHUNK_SIZE), **params)
+  except UnicodeDecodeError:
+    # All ASCII as far as we sniffed, and then something that isn't UTF-8
+    # further down. That's rare enough that reading it all again is fine.
+    if conclusive or chunksize:
+      raise
+    params['encoding'] = 'latin-1'
+    __remember_sniffed(__sniff_key(url, response_headers), (params, True))
+    return pd.read_csv(io.BufferedReader(ChunkStream(__iter_resumable(url)), READ_CHUNK_SIZE), **params)
 
+# Works out read_csv params (encoding, sep, quotechar) from a sample of the
+# start of a CSV file. The second thing returned is whether the sample was
+# enough to go on: plain ASCII could still turn out to be something else
+# further down, so a bigger sample would be worth a look.
+def sniff_csv(sample):
+  # Don't cut a character (or row) in half
+  end = sample.rfind(b'\n')
+  if end > 0:
+    sample = sample[:end + 1]
+
+  detected = magic().from_buffer(sample)
+  conclusive = detected != 'us-ascii'
+  encoding = SNIFFED_ENCODINGS.get(detected, detected)
+
+  params = dict()
+  if encoding:
+    params['encoding'] = encoding
+
+  try:
+    text = sample[:SNIFF_WINDOW].decode(encoding or 'utf-8', errors='replace')
+    dialect = csv.Sniffer().sniff(text, delimiters=SNIFF_DELIMITERS)
+    params['sep'] = dialect.delimiter
+    params['quotechar'] = dialect.quotechar
+  except (csv.Error, LookupError):
+    # Not enough to go on, so stick with pandas' defaults
+    pass
+
+  return params, conclusive
+
+# Reads a dataset stored in one of the formats synthi.formats knows how to
+# decode (Parquet, Arrow, JSON lines, ...) into a DataFrame, or an iterator of
+# them with `chunksize`.
+def read_format(url, format, chunksize=None):
+  decode = FORMAT_DECODERS[format]
+  source = io.BufferedReader(ChunkStream(__iter_resumable(url)), READ_CHUNK_SIZE)
+  return decode(source, chunksize=chunksize)
+
+# The MD5 of the body goes along with it so that the object store can refuse
+# anything that got mangled on the way (Swift checks ETag, S3 Content-MD5), and
+# we check the ETag it answers with as well. urllib3 already retries a PUT that
+# fails to connect or gets a gateway error.
+#
+# There's no resuming uploads: the store only gives us the one pre-signed URL,
+# while segmented uploads need to write each segment as its own object.
 def write_raw(data, url):
-  res = requests.put(url, data)
-  if res.status_code != 200 and res.status_code != 201:
-    raise Exception("Failed to write dataset")
+  if isinstance(data, str):
+    data = data.encode('utf-8')
+
+  checksum = None
+  headers = {}
+  if isinstance(data, (builtins.bytes, bytearray)):
+    checksum = hashlib.md5(data)
+    headers = { 'ETag': checksum.hexdigest(), 'Content-MD5': base64.b64encode(checksum.digest()).decode('ascii') }
+
+  res = session().put(url, data, headers=headers, timeout=__timeout)
+  __check_written(res, url, checksum)
+
+  return manifest(len(data) if checksum else None, checksum)
 
-def write_csv(df, url):
-  data = df.to_csv(index=False).encode('utf-8')
-  write_raw(data, url)
+# The CSV is encoded and sent a block of rows at a time (as a chunked upload),
+# so the upload starts right away and there's never more than one block of it
+# in memory. The MD5 can only be known once it's all gone out, so it's checked
+# against the ETag the store answers with rather than sent along.
+def write_csv(df, url, chunk_rows=CSV_CHUNK_ROWS):
+  return write_chunks(lambda: iter_csv_chunks(df, chunk_rows), url, rows=len(df))
+
+# `chunks` is called to get an iterator over the body, once per attempt
+def write_chunks(chunks, url, rows=None):
+  body = ReplayableBody(chunks)
+  res = session().put(url, body, timeout=__timeout)
+  __check_written(res, url, body.checksum)
+
+  return manifest(body.size, body.checksum, rows=rows)
+
+# A request body made of chunks that can start over from the beginning, which
+# is what urllib3 does with the body when it retries. Each time through, it
+# keeps count of the size and MD5 of what it sent.
+class ReplayableBody:
+  def __init__(self, chunks):
+    self.chunks = chunks
+    self.size = 0
+    self.checksum = hashlib.md5()
+
+  def __iter__(self):
+    self.size = 0
+    self.checksum = hashlib.md5()
+    for chunk in self.chunks():
+      self.size += len(chunk)
+      self.checksum.update(chunk)
+      yield chunk
 
 async def adf_chunk_encoder(dfs):
+  loop = asyncio.get_running_loop()
   # We only want to write a header from the first chunk
   first_chunk = True
 
   async for chunk in dfs:
-    encoded_chunk = chunk.to_csv(index=False, header=first_chunk).encode('utf-8')
+    # Encoding is done off the event loop, so that it can overlap with sending
+    # the chunks before it
+    encoded_chunk = await loop.run_in_executor(None, lambda: chunk.to_csv(index=False, header=first_chunk).encode('utf-8'))
     first_chunk = False
     yield encoded_chunk
 
 async def write_csv_stream(dfs, url):
-  data = adf_chunk_encoder(dfs)
-  client = httpx.AsyncClient()
-  res = await client.put(url, data=data)
-  await client.aclose()
-  if res.status_code != 200 and res.status_code != 201:
-    raise Exception("Failed to write dataset")
+  rows = 0
 
+  async def counted():
+    nonlocal rows
+    async for df in dfs:
+      rows += len(df)
+      yield df
+
+  return { **(await write_raw_stream(adf_chunk_encoder(counted()), url)), 'rows': rows }
+
+# A stream can only be sent once, so unlike write_raw() nothing here is retried.
+# We can still checksum it on the way out and compare against the ETag the
+# store comes back with, to at least know the whole thing got there intact.
 async def write_raw_stream(data, url):
-  client = httpx.AsyncClient()
-  res = await client.put(url, data=data)
-  await client.aclose()
-  if res.status_code != 200 and res.status_code != 201:
-    raise Exception("Failed to write dataset")
+  checksum = hashlib.md5()
+  size = 0
+
+  async def checksummed():
+    nonlocal size
+    async for chunk in data:
+      if isinstance(chunk, str):
+        chunk = chunk.encode('utf-8')
+      checksum.update(chunk)
+      size += len(chunk)
+      yield chunk
+
+  import httpx
+  async with httpx.AsyncClient(timeout=__timeout) as client:
+    res = await client.put(url, content=checksummed())
+  __check_written(res, url, checksum)
 
+  return manifest(size, checksum)
+
+# What the writers hand back about what they wrote, so the transformation can
+# fill in its metadata without asking the object store afterwards. `bytes` is
+# None when it couldn't be known (e.g. writing from a file object).
+def manifest(size, checksum, rows=None):
+  return dict(
+    bytes = size,
+    rows = rows,
+    md5 = checksum.hexdigest() if checksum else None
+  )
+
+# A file-like view of an iterator of byte chunks, for things like pd.read_csv
+# that want to read() rather than iterate.
+class ChunkStream(io.RawIOBase):
+  def __init__(self, chunks):
+    self.chunks = iter(chunks)
+    self.pending = b''
+
+  def readable(self):
+    return True
+
+  def readinto(self, buffer):
+    while not self.pending:
+      chunk = next(self.chunks, None)
+      if chunk is None:
+        return 0
+      self.pending = memoryview(chunk)
+
+    size = min(len(buffer), len(self.pending))
+    buffer[:size] = self.pending[:size]
+    self.pending = self.pending[size:]
+    return size
+
+  def close(self):
+    if hasattr(self.chunks, 'close'):
+      self.chunks.close()
+    super().close()
+
+# Transformation scripts come in as code, so they're written out to a file
+# and imported from there. Each gets a module (and module name) of its own, so
+# two scripts, or two versions of the same one, never share any state.
+def load_script_module(code):
+  if isinstance(code, str):
+    code = code.encode('utf-8')
+
+  with NamedTemporaryFile(prefix=SCRIPT_PREFIX, suffix='.py', delete=False) as script:
+    script.write(code)
+
+  name = os.path.basename(script.name)[:-len('.py')]
+  spec = spec_from_file_location(name, script.name)
+  module = module_from_spec(spec)
+  # Some things (dataclasses, pickle) look a module up by name while it runs
+  sys.modules[name] = module
+  try:
+    # Rather than spec.loader.exec_module(), which would leave compiled
+    # bytecode behind next to the file
+    exec(compile(code, script.name, 'exec'), vars(module))
+  except BaseException:
+    cleanup_script_module(module)
+    raise
+
+  return module
+
+# Undoes load_script_module(): the module is forgotten, its file removed and
+# its globals cleared, so that anything it held on to (DataFrames kept at
+# module level, open connections) can be freed even if something still has a
+# reference to the module itself.
 def cleanup_script_module(module):
-  pass
+  name = module.__name__
+  if sys.modules.get(name) is module:
+    del sys.modules[name]
+
+  path = getattr(module, '__file__', None)
+  if path and os.path.basename(path).startswith(SCRIPT_PREFIX):
+    try:
+      os.unlink(path)
+    except FileNotFoundError:
+      pass
+
+  vars(module).clear()
+
+# Returns None if the object is too small, the server can't do ranges or the
+# object changed while we were at it, and the caller should just fall back to
+# a plain GET.
+def __read_ranges(url, parts):
+  head = probe(session(), url, timeout=__timeout)
+  if not accepts_ranges(head):
+    return None
+
+  size = int(head.headers['Content-Length'])
+  try:
+    data = download_ranges(session(), head.url, size, head, parts=parts, timeout=__timeout)
+  except ObjectChanged:
+    return None
+  __verify(url, head.headers, len(data), hashlib.md5(data))
+
+  return data
+
+# Sniffs from the first chunks of `chunks`, and hands back the params along
+# with chunks that still start from the beginning.
+def __sniff_stream(url, chunks, response_headers):
+  head = []
+  size = 0
+  window = SNIFF_WINDOW
+
+  while True:
+    for chunk in chunks:
+      head.append(chunk)
+      size += len(chunk)
+      if size >= window:
+        break
+
+    # The first chunk has come in by now, so we know which version of the
+    # object this is
+    key = __sniff_key(url, response_headers)
+    sniffed = __sniffed_params(key)
+    if sniffed is not None:
+      params, conclusive = sniffed
+      break
+
+    params, conclusive = sniff_csv(b''.join(head)[:window])
+    if conclusive or size < window or window >= MAX_SNIFF_WINDOW:
+      # Having seen the whole file is as good as it gets
+      conclusive = conclusive or size < window
+      __remember_sniffed(key, (params, conclusive))
+      break
+    window = min(window * 4, MAX_SNIFF_WINDOW)
+
+  return params, conclusive, itertools.chain(head, chunks)
+
+def __sniff_buffer(url, data):
+  key = __sniff_key(url, { 'ETag': hashlib.md5(data).hexdigest() })
+  sniffed = __sniffed_params(key)
+  if sniffed is None:
+    # With the whole file already here, there's no reason to stop at a window
+    sniffed = (sniff_csv(data)[0], True)
+    __remember_sniffed(key, sniffed)
+  return sniffed[0]
+
+def __sniff_key(url, headers):
+  etag = headers.get('ETag')
+  return (urlparse(url).path, etag) if etag else None
+
+def __sniffed_params(key):
+  if key is None:
+    return None
+  with __sniffed_lock:
+    sniffed = __sniffed.get(key)
+    if sniffed is not None:
+      __sniffed.move_to_end(key)
+    return sniffed
+
+def __remember_sniffed(key, sniffed):
+  if key is None:
+    return
+  with __sniffed_lock:
+    __sniffed[key] = sniffed
+    while len(__sniffed) > SNIFF_CACHE_SIZE:
+      __sniffed.popitem(last=False)
+
+# Streams the object at `url`, and if the connection drops partway through,
+# asks for just the rest of it (If-Match makes sure it's still the same object)
+# instead of starting over. Once it's all there, the size and MD5 are checked
+# against what the server said.
+#
+# `response_headers`, if given, gets filled in with the headers of the
+# response once it starts.
+def __iter_resumable(url, chunksize=READ_CHUNK_SIZE, response_headers=None):
+  offset = 0
+  attempt = 0
+  checksum = hashlib.md5()
+  headers = { 'Accept-Encoding': 'identity' }
+  headers_out = response_headers
+  response_headers = None
+
+  while True:
+    try:
+      with session().get(url, headers=headers, stream=True, timeout=__timeout) as res:
+        expected = 206 if offset else 200
+        if res.status_code != expected:
+          raise StorageError(f"Failed to read dataset {url} got {res.status_code}", url=url, status=res.status_code)
+
+        if not offset:
+          response_headers = res.headers
+          if headers_out is not None:
+            headers_out.update(res.headers)
+
+        for chunk in res.iter_content(chunk_size=chunksize):
+          checksum.update(chunk)
+          offset += len(chunk)
+          yield chunk
+      break
+    except TRANSIENT_ERRORS as e:
+      # Offsets into a body compressed in transit don't mean anything to Range
+      resumable = response_headers is None or 'Content-Encoding' not in response_headers
+      if not resumable or attempt >= __retries:
+        raise StorageError(f"Failed to read dataset {url} after {offset} bytes: {e}", url=url) from e
+
+      attempt += 1
+      time.sleep(__backoff_factor * (2 ** attempt))
+
+      if response_headers is not None:
+        etag = response_headers.get('ETag')
+        headers = { 'Accept-Encoding': 'identity', 'Range': f"bytes={offset}-", **({ 'If-Match': etag } if etag else {}) }
+
+  __verify(url, response_headers, offset, checksum)
+
+def __verify(url, headers, size, checksum):
+  if 'Content-Encoding' in headers:
+    return
+
+  expected_size = headers.get('Content-Length')
+  if expected_size is not None and int(expected_size) != size:
+    raise StorageError(f"Read {size} of {expected_size} bytes from {url}", url=url)
+
+  expected = __md5_etag(headers)
+  if expected and expected != checksum.hexdigest():
+    raise StorageError(f"Checksum mismatch reading {url}: expected {expected}, got {checksum.hexdigest()}", url=url)
+
+def __check_written(res, url, checksum=None):
+  if res.status_code != 200 and res.status_code != 201:
+    raise StorageError(f"Failed to write dataset {url} got {res.status_code}", url=url, status=res.status_code)
+
+  expected = __md5_etag(res.headers)
+  if checksum and expected and expected != checksum.hexdigest():
+    raise StorageError(f"Checksum mismatch writing {url}: sent {checksum.hexdigest()}, stored {expected}", url=url)
+
+# ETags are only the MD5 of the content for plain objects. Large (segmented or
+# multipart) objects get something else, e.g. "<md5>-<parts>" on S3.
+def __md5_etag(headers):
+  if 'X-Static-Large-Object' in headers or 'X-Object-Manifest' in headers:
+    return None
+
+  etag = (headers.get('ETag') or '').lower()
+  if etag.startswith('w/'):
+    return None
+
+  etag = etag.strip('"')
+  return etag if re.fullmatch('[0-9a-f]{32}', etag) else None
 
 def __metadata(url):
-  res = requests.head(url)
+  res = session().head(url, timeout=__timeout)
   if res.status_code != 200:
-    raise Exception(f"Failed to read metadata for dataset {url} got {res.status_code}")
+    raise StorageError(f"Failed to read metadata for dataset {url} got {res.status_code}", url=url, status=res.status_code)
 
   return res.headers
 
@@ -1,106 +1,429 @@
 import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from .transformation import Transformation, default_analyzer
-from . import storage
+from ..formats import FORMAT_DECODERS, is_frame
+from . import storage, serializers
+from .process_pool import process_pool, run_transform
 
-def create_stream_loader(chunksize):
+# How many results each consumer (writer, sampler, analyzer) can fall behind
+# before the transform has to wait for it
+DEFAULT_QUEUE_SIZE = 4
+
+# Rows read to get a first idea of how wide rows are, with target_chunk_bytes
+FIRST_CHUNK_ROWS = 1000
+# Rows looked at to measure that on every chunk after
+WIDTH_SAMPLE_ROWS = 1000
+
+# Streams inputs either `chunksize` rows at a time, or with `target_chunk_bytes`,
+# in chunks of about that many bytes (in memory, as a DataFrame) however wide
+# the rows turn out to be. How that went ends up in metadata['chunks'].
+def create_stream_loader(chunksize=None, target_chunk_bytes=None):
   def stream_loader(datamap, variant='imported'):
     if datamap['storage'] == 'swift-tempurl':
-      if datamap['format'] == 'csv':
-        return storage.read_csv(datamap['value'][variant], chunksize=chunksize)
+      url = datamap['value'][variant]
+      if target_chunk_bytes and datamap['format'] == 'csv':
+        reader = storage.read_csv(url, chunksize=FIRST_CHUNK_ROWS)
+        return AdaptiveChunks(csv_rows(reader), target_chunk_bytes)
+      elif target_chunk_bytes and datamap['format'] in FORMAT_DECODERS:
+        frames = storage.read_format(url, datamap['format'], chunksize=FIRST_CHUNK_ROWS)
+        return AdaptiveChunks(frame_rows(frames), target_chunk_bytes)
+      elif datamap['format'] == 'csv':
+        return storage.read_csv(url, chunksize=chunksize)
+      elif datamap['format'] in FORMAT_DECODERS:
+        return storage.read_format(url, datamap['format'], chunksize=chunksize)
       else:
-        return storage.read_raw(datamap['value'][variant])
+        return storage.read_raw(url)
     else:
       raise Exception(f"Don't know how to deal with storage: {datamap['storage']}")
   return stream_loader
 
+# Hands out chunks of DataFrames sized to come to about `target_bytes` each.
+# `read(rows)` should return the next `rows` rows (or fewer at the end, and
+# None once there's nothing left). Row width is measured on a slice of every
+# chunk and averaged with what came before, so the chunk size follows the data
+# without swinging around on one odd chunk.
+class AdaptiveChunks:
+  def __init__(self, read, target_bytes, first_rows=FIRST_CHUNK_ROWS):
+    self.read = read
+    self.target_bytes = target_bytes
+    self.rows = first_rows
+    self.row_bytes = None
+    self.chunks = 0
+    self.total_rows = 0
+    self.min_rows = None
+    self.max_rows = 0
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    df = self.read(self.rows)
+    if df is None or len(df) == 0:
+      raise StopIteration
+
+    sample = df.iloc[:WIDTH_SAMPLE_ROWS]
+    width = max(1, sample.memory_usage(deep=True, index=False).sum() / len(sample))
+    self.row_bytes = width if self.row_bytes is None else (self.row_bytes + width) / 2
+    self.rows = max(1, int(self.target_bytes / self.row_bytes))
+
+    self.chunks += 1
+    self.total_rows += len(df)
+    self.min_rows = len(df) if self.min_rows is None else min(self.min_rows, len(df))
+    self.max_rows = max(self.max_rows, len(df))
+
+    return df
+
+  def stats(self):
+    return dict(
+      chunks = self.chunks,
+      rows = self.total_rows,
+      min_rows = self.min_rows or 0,
+      max_rows = self.max_rows,
+      row_bytes = int(self.row_bytes or 0),
+      target_bytes = self.target_bytes
+    )
+
+# pandas' chunked CSV reader can already be asked for any number of rows
+def csv_rows(reader):
+  def read(rows):
+    try:
+      return reader.get_chunk(rows)
+    except StopIteration:
+      reader.close()
+      return None
+  return read
+
+# Anything else comes in fixed size frames, which get put together or split
+# up to make the number of rows asked for
+def frame_rows(frames):
+  import pandas as pd
+  leftover = None
+
+  def read(rows):
+    nonlocal leftover
+    parts = [leftover] if leftover is not None else []
+    have = len(leftover) if leftover is not None else 0
+    leftover = None
+
+    while have < rows:
+      frame = next(frames, None)
+      if frame is None:
+        break
+      parts.append(frame)
+      have += len(frame)
+
+    if not parts:
+      return None
+
+    df = pd.concat(parts, ignore_index=True) if len(parts) > 1 else parts[0]
+    if len(df) > rows:
+      leftover = df.iloc[rows:]
+      df = df.iloc[:rows]
+    return df
+
+  return read
+
+# Profiles every chunk as it goes by rather than just the first one, so a
+# column that only turns out to hold floats (or text) further down still gets
+# the right tag. Per-column stats end up in metadata['profile'].
 async def default_stream_analyzer(dfs, metadata):
-  recorded = False
+  from .profiling import Profile
+
+  loop = asyncio.get_running_loop()
+  profile = Profile()
+  first = True
+
   async for df in dfs:
-    if not recorded:
+    if first and not is_frame(df):
       default_analyzer(df, metadata)
-      recorded = True
+      return
+    first = False
+
+    await loop.run_in_executor(None, profile.update, df)
+
+  if not first:
+    profile.record(metadata)
 
 async def default_stream_writer(data, datamap, variant='imported'):
   if datamap['storage'] == 'swift-tempurl':
-    # TODO: Should probably figure out from the return type and not the passed in format
-    if datamap['format'] == 'csv':
-      await storage.write_csv_stream(data, datamap['value'][variant])
-    else:
-      await storage.write_raw_stream(data, datamap['value'][variant])
+    return await serializers.write_stream(data, datamap['format'], datamap['value'][variant])
   else:
     raise Exception(f"Don't know how to deal with storage: {datamap['storage']}")
 
 class StreamTransformation(Transformation):
-  def __init__(self, *args, **kwargs):
+  # With `workers` > 1, that many chunks are transformed at the same time
+  # (results still come out in order), so transform functions shouldn't
+  # depend on state carried over from a previous chunk.
+  #
+  # Threads are enough when the transform spends its time inside pandas/numpy
+  # (which mostly let go of the GIL). For transforms doing a lot of their own
+  # python work per row, `parallel` runs them in that many worker processes
+  # instead, with at most that many chunks being transformed at once.
+  #
+  # `align`, `key` and `broadcast` say how several streamed inputs are lined
+  # up with each other, see ParamStream.
+  def __init__(self, *args, workers=1, parallel=None, queue_size=DEFAULT_QUEUE_SIZE, align='zip', key=None, broadcast=(), **kwargs):
     streamargs = { 'analyzer': default_stream_analyzer, 'writer': default_stream_writer, **kwargs }
     super().__init__(*args, **streamargs)
+    self.workers = workers
+    self.parallel = parallel
+    self.queue_size = queue_size
+    self.align = align
+    self.key = key
+    self.broadcast = broadcast
 
   def load(self, input_params):
     loaded_params = super().load(input_params)
-    return ParamStream(loaded_params)
+    return ParamStream(loaded_params, align=self.align, key=self.key, broadcast=self.broadcast)
 
+  # The sample is drawn from the whole stream and only written out once it's
+  # done, so it's `sample_size` rows no matter how many chunks there were.
   def output_sample(self, results, outputptr):
     async def async_output_sample(results):
+      from .profiling import Reservoir
+      reservoir = Reservoir(self.sample_size, seed=self.sample_seed)
+      sampled = False
       async for result in results:
-        yield self.sample(result)
-        
+        if is_frame(result):
+          reservoir.update(result)
+          sampled = True
+
+      yield reservoir.sample() if sampled else self.sample(None)
+
     return self.writer(async_output_sample(results), outputptr, variant='sample')
 
   def run(self, params):
     param_chunks = self.load(params['input'])
-    results = (self.transform(chunk) for chunk in param_chunks)
-    (r1, r2, r3) = fork_iter(results, 3)
-    async def tasks():
-      await asyncio.gather(
-        self.output(r1, params['output']),
-        self.output_sample(r2, params['output']),
-        self.record_result_metadata(r3)
-      )
-    asyncio.run(tasks())
+
+    async def output(results):
+      self.output_manifest = await self.output(results, params['output'])
+
+    consumers = [
+      output,
+      lambda results: self.output_sample(results, params['output']),
+      self.record_result_metadata
+    ]
+
+    if self.parallel:
+      executor = process_pool(self.transform, self.parallel)
+      transform, workers = run_transform, self.parallel
+    else:
+      executor = ThreadPoolExecutor(max_workers=self.workers)
+      transform, workers = self.transform, self.workers
+
+    with executor:
+      asyncio.run(fan_out(param_chunks, transform, consumers, executor, workers=workers, queue_size=self.queue_size))
+
+    chunk_stats = param_chunks.chunk_stats()
+    if chunk_stats:
+      self.metadata['chunks'] = chunk_stats
+
     self.record_storage_metadata(params['output'])
 
+ALIGNMENTS = ('zip', 'merge')
+
+# Turns the loaded inputs into a stream of keyword arguments for the transform
+# function. Inputs that are iterators (e.g. CSV read with a chunksize) are
+# streamed a chunk at a time, and everything else is passed along whole with
+# every chunk.
+#
+# With more than one streamed input, `align` says how their chunks line up:
+#
+# - 'zip': chunk n of every input goes together. They all have to run out at
+#   the same point.
+# - 'merge': every input is sorted by the `key` column, and each call gets the
+#   rows of every input for the same range of keys, so that rows with equal
+#   keys always end up in the same call (a sorted-merge join).
+#
+# Inputs named in `broadcast` are read in full once up front, and then passed
+# whole with every chunk like any other non-streamed input. That's the way to
+# join a big stream against smaller lookup tables.
 class ParamStream:
-  def __init__(self, params):
-    self.params = params
+  def __init__(self, params, align='zip', key=None, broadcast=()):
+    if align not in ALIGNMENTS:
+      raise ValueError(f"Unknown alignment {align}, should be one of {', '.join(ALIGNMENTS)}")
+    if align == 'merge' and not key:
+      raise ValueError("Merging streamed inputs needs a key column")
+
+    self.align = align
+    self.key = key
+    self.static = dict()
+    self.streams = dict()
+
+    for k,v in params.items():
+      if not hasattr(v, '__next__'):
+        # Not all parameters will be iterable. But the transformation function
+        # will still need them
+        self.static[k] = v
+      elif k in broadcast:
+        import pandas as pd
+        self.static[k] = pd.concat(list(v), ignore_index=True)
+      else:
+        self.streams[k] = v
+
     self.__first_iteration_complete = False
+    self.__buffers = { k: None for k in self.streams }
+    self.__exhausted = set()
+    # The last key pulled from each input, to check it stays sorted from one
+    # chunk to the next
+    self.__last_keys = dict()
 
   def __iter__(self):
     return self
 
+  # For inputs that keep track of how they were chunked (see AdaptiveChunks)
+  def chunk_stats(self):
+    return { k: stream.stats() for k, stream in self.streams.items() if hasattr(stream, 'stats') }
+
   def __next__(self):
-    internal_iter = None
-    internal_iter_stopped = False
+    if not self.streams:
+      # With absolutely no streamed inputs, there's just the one call
+      if self.__first_iteration_complete:
+        raise StopIteration
+      self.__first_iteration_complete = True
+      return dict(self.static)
+
+    if len(self.streams) == 1 or self.align == 'zip':
+      chunks = self.__next_zipped()
+    else:
+      chunks = self.__next_merged()
+
+    return { **self.static, **chunks }
 
-    param_chunk = dict()
-    for k,v in self.params.items():
+  def __next_zipped(self):
+    chunks = dict()
+    for k, stream in self.streams.items():
       try:
-        param_chunk[k] = next(v)
-        # If we have absolutely no internal iterators, we will want to stop
-        # after the first iteration.
-        if internal_iter and internal_iter != k:
-          raise Exception("Param stream should only have one iterable param")
-        internal_iter = k
-      except TypeError:
-        # Not all parameters will be iterable. But the transformation function 
-        # will still need them
-        param_chunk[k] = v
+        chunks[k] = next(stream)
       except StopIteration:
-        internal_iter_stopped = True
+        pass
 
-    if (self.__first_iteration_complete and not internal_iter) or internal_iter_stopped:
+    if not chunks:
       raise StopIteration
+    if len(chunks) < len(self.streams):
+      stopped = ', '.join(sorted(set(self.streams) - set(chunks)))
+      raise Exception(f"Streamed inputs ran out of chunks at different points ({stopped} first), use align='merge' or broadcast instead")
+
+    return chunks
+
+  # Every input has all of its rows below the smallest of the inputs' last
+  # buffered keys, so those can go out together. Whichever input(s) that
+  # smallest key came from need their next chunk before we can go further.
+  def __next_merged(self):
+    while True:
+      for k in self.streams:
+        while k not in self.__exhausted and (self.__buffers[k] is None or len(self.__buffers[k]) == 0):
+          self.__pull(k)
+
+      pending = [k for k in self.streams if k not in self.__exhausted]
+      if not pending:
+        if all(len(buffer) == 0 for buffer in self.__buffers.values()):
+          raise StopIteration
+        chunks = self.__buffers
+        self.__buffers = { k: buffer.iloc[0:0] for k, buffer in chunks.items() }
+        return chunks
+
+      bound = min(self.__buffers[k][self.key].iloc[-1] for k in pending)
+      chunks = dict()
+      for k, buffer in self.__buffers.items():
+        split = buffer[self.key].searchsorted(bound, side='left')
+        chunks[k] = buffer.iloc[:split]
+        self.__buffers[k] = buffer.iloc[split:]
+
+      for k in pending:
+        if self.__buffers[k][self.key].iloc[-1] == bound:
+          self.__pull(k)
+
+      if any(len(chunk) > 0 for chunk in chunks.values()):
+        return chunks
+
+  def __pull(self, k):
+    import pandas as pd
+    buffer = self.__buffers[k]
+    try:
+      chunk = next(self.streams[k])
+    except StopIteration:
+      self.__exhausted.add(k)
+      if buffer is None:
+        # An input with nothing in it at all. There's no chunk to take its
+        # columns from, so the transform function gets an empty frame with
+        # only the key column for it.
+        self.__buffers[k] = pd.DataFrame(columns=[self.key])
+      return
+
+    keys = chunk[self.key]
+    if not keys.is_monotonic_increasing or (len(keys) and k in self.__last_keys and keys.iloc[0] < self.__last_keys[k]):
+      raise Exception(f"Streamed input {k} has to be sorted by {self.key} to be merged")
+    if len(keys):
+      self.__last_keys[k] = keys.iloc[-1]
+
+    self.__buffers[k] = chunk if buffer is None or len(buffer) == 0 else pd.concat([buffer, chunk])
+
+__done = object()
+
+# Runs each chunk through `transform` and hands every result to all of the
+# `consumers` (each called with an async iterator of results, returning
+# something to await). Reading the next chunk and transforming happen in
+# executors, so they overlap with the consumers' writes on the event loop. Each
+# consumer gets its own bounded queue: when one falls `queue_size` results
+# behind, transforming stops until it catches up, instead of results piling up
+# in memory.
+async def fan_out(chunks, transform, consumers, executor, workers=1, queue_size=DEFAULT_QUEUE_SIZE):
+  loop = asyncio.get_running_loop()
+  queues = [asyncio.Queue(maxsize=queue_size) for _ in consumers]
+
+  async def publish(result):
+    for queue in queues:
+      await queue.put(result)
+
+  async def produce():
+    # Only one thread at a time may pull from the chunk iterator
+    with ThreadPoolExecutor(max_workers=1) as reader:
+      pending = deque()
+      try:
+        while True:
+          chunk = await loop.run_in_executor(reader, next, chunks, __done)
+          if chunk is __done:
+            break
+
+          pending.append(loop.run_in_executor(executor, transform, chunk))
+          if len(pending) >= workers:
+            await publish(await pending.popleft())
+
+        while pending:
+          await publish(await pending.popleft())
+      finally:
+        # If something went wrong, nobody is going to wait on the rest
+        for future in pending:
+          future.cancel()
+
+    await publish(__done)
+
+  async def consume(consumer, queue):
+    finished = False
 
-    self.__first_iteration_complete = True
+    async def results():
+      nonlocal finished
+      while True:
+        result = await queue.get()
+        if result is __done:
+          finished = True
+          return
+        yield result
 
-    return param_chunk
+    await consumer(results())
 
-def fork_iter(iter, num):
-  from itertools import tee
-  iters = list(tee(iter, num))
-  return [__pausable(i) for i in iters]
+    # Anything the consumer didn't want still has to be taken off its queue,
+    # or the producer would wait on it forever
+    while not finished:
+      finished = await queue.get() is __done
 
-async def __pausable(iter):
-  for i in iter:
-    await asyncio.sleep(0)
-    yield i
\ No newline at end of file
+  tasks = [asyncio.ensure_future(produce())] + [asyncio.ensure_future(consume(consumer, queue)) for consumer, queue in zip(consumers, queues)]
+  try:
+    await asyncio.gather(*tasks)
+  except BaseException:
+    for task in tasks:
+      task.cancel()
+    raise
@@ -1,9 +1,9 @@
 from types import FunctionType
 import os
-import pandas as pd
 import requests
 import hashlib
-from . import storage
+from ..formats import FORMAT_DECODERS, is_frame
+from . import storage, serializers
 
 SAMPLE_SIZE=100
 
@@ -11,46 +11,45 @@ def default_loader(datamap, variant='imported'):
   if datamap['storage'] == 'swift-tempurl':
     if datamap['format'] == 'csv':
       return storage.read_csv(datamap['value'][variant])
+    elif datamap['format'] in FORMAT_DECODERS:
+      return storage.read_format(datamap['value'][variant], datamap['format'])
     else:
       return storage.read_raw(datamap['value'][variant])
   else:
     raise Exception(f"Don't know how to deal with storage: {datamap['storage']}")
 
+# DataFrames are written in the output's format (see serializers), anything
+# else as raw bytes
 def default_writer(data, datamap, variant='imported'):
   if datamap['storage'] == 'swift-tempurl':
-    # TODO: Should probably figure out from the return type and not the passed in format
-    if datamap['format'] == 'csv':
-      storage.write_csv(data, datamap['value'][variant])
-    else:
-      storage.write_raw(data, datamap['value'][variant])
+    return serializers.write(data, datamap['format'], datamap['value'][variant])
   else:
     raise Exception(f"Don't know how to deal with storage: {datamap['storage']}")
 
+# Besides the column tags, this records per-column stats (null counts,
+# min/max, approximate distinct counts) in metadata['profile'].
 def default_analyzer(data, metadata):
-  if type(data) is pd.DataFrame:
-    column_types = data.dtypes
-    columns = [
-      dict(
-        name=name,
-        originalName=name,
-        tags=[convert_type(column_types[name])],
-        order=i+1
-      ) for i, name in enumerate(data.columns)
-    ]
-    metadata['columns'] = columns
-    metadata['type'] = 'csv'
+  if is_frame(data):
+    from .profiling import Profile
+    profile = Profile()
+    profile.update(data)
+    profile.record(metadata)
   else:
     metadata['type'] = 'document'
 
 class Transformation:
-  def __init__(self, transform_func, loader={}, writer=default_writer, analyzer=default_analyzer, inputs={}):
+  # `sample_seed` makes the rows picked for the sample the same on every run
+  def __init__(self, transform_func, loader={}, writer=default_writer, analyzer=default_analyzer, inputs={}, sample_size=SAMPLE_SIZE, sample_seed=None):
     self.transform_func = transform_func
+    self.sample_size = sample_size
+    self.sample_seed = sample_seed
     loader_defaults = { 'default': default_loader }
     self.loader = { **loader_defaults, **loader }
     self.writer = writer
     self.analyzer = analyzer
     self.inputs = inputs
     self.metadata = dict()
+    self.output_manifest = None
 
   def __call__(self, *args, **kwargs):
     return self.transform_func(*args, **kwargs)
@@ -85,9 +84,9 @@ class Transformation:
 
   def sample(self, result):
     sample_data = ""
-    if type(result) is pd.DataFrame:
-      sample_size = min(result.shape[0], SAMPLE_SIZE)
-      sample_data = result.sample(sample_size)
+    if is_frame(result):
+      from .profiling import sample_rows
+      sample_data = sample_rows(result, self.sample_size, seed=self.sample_seed)
     return sample_data
     
   def output_sample(self, result, outputptr):
@@ -97,13 +96,23 @@ class Transformation:
   def record_result_metadata(self, result):
     return self.analyzer(result, self.metadata)
 
+  # Writers can return a manifest (see storage.manifest) of what they wrote.
+  # Only when they don't do we have to go back and ask storage for the size.
   def record_storage_metadata(self, outputptr):
-    self.metadata['bytes'] = storage.bytes(outputptr['value']['imported'])
+    manifest = self.output_manifest or {}
+    if manifest.get('bytes') is None:
+      self.metadata['bytes'] = storage.bytes(outputptr['value']['imported'])
+      return
+
+    self.metadata['bytes'] = manifest['bytes']
+    for key in ('rows', 'md5'):
+      if manifest.get(key) is not None:
+        self.metadata[key] = manifest[key]
 
   def run(self, params):
     loaded = self.load(params['input'])
     results = self.transform(loaded)
-    self.output(results, params['output'])
+    self.output_manifest = self.output(results, params['output'])
     self.output_sample(results, params['output'])
     self.record_result_metadata(results)
     self.record_storage_metadata(params['output'])
@@ -135,14 +144,5 @@ def dataset(name, org=None, variant="imported"):
   return { 'ref': name, 'reftype': 'dataset', 'variant': variant }
 
 def convert_type(pd_type):
-  if pd_type == 'object':
-    return 'String'
-  elif pd_type == 'int64':
-    return 'Integer'
-  elif pd_type == 'float64':
-    return 'Float'
-  elif pd_type == 'bool':
-    return 'Boolean'
-  else:
-    # String is a good default if nothing more specific can be found
-    return 'String'
+  from .profiling import dtype_tag
+  return dtype_tag(pd_type)
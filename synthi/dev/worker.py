@@ -0,0 +1,197 @@
+import io
+import os
+import sys
+import copy
+import json
+import time
+import signal
+import hashlib
+import argparse
+import socketserver
+from collections import OrderedDict
+from contextlib import redirect_stdout
+from threading import Lock
+
+from . import storage
+from .transformation import Transformation
+
+# How many transformation scripts are kept loaded at once
+DEFAULT_CACHE_SIZE = 64
+
+# A long running worker that takes transformation runs one after another, so
+# that importing pandas, setting up connections and loading the script are
+# paid for once rather than on every run. Requests come in as JSON lines:
+#
+#   { "id": 1, "code": "<script>", "transformation": "first10", "params": { "input": ..., "output": ... } }
+#
+# `path` can be given instead of `code` to load the script from a file, and
+# `transformation` can be left out if the script only defines one. Each
+# request gets a line back, either:
+#
+#   { "id": 1, "status": "ok", "metadata": { ... }, "elapsed": 0.012 }
+#   { "id": 1, "status": "error", "error": "..." }
+#
+# Run it with: python -m synthi.dev.worker [--socket PATH]
+
+# A loaded transformation script, along with its globals as they were right
+# after loading, so they can be put back after every run.
+class Script:
+  def __init__(self, code):
+    self.module = storage.load_script_module(code)
+    self.globals = dict(vars(self.module))
+    self.transformations = {
+      name: value for name, value in self.globals.items()
+      if isinstance(value, Transformation)
+    }
+
+  def transformation(self, name=None):
+    if name:
+      if name not in self.transformations:
+        raise ValueError(f"Script has no transformation called {name}")
+      return self.transformations[name]
+
+    if len(self.transformations) != 1:
+      raise ValueError(f"Script defines {len(self.transformations)} transformations, say which one to run")
+    return next(iter(self.transformations.values()))
+
+  # Anything a run (re)assigned at module level is put back, so the next run
+  # starts from the same place. Objects changed in place are another matter:
+  # a script that appends to a module level list will still see it grow.
+  def reset(self):
+    namespace = vars(self.module)
+    namespace.clear()
+    namespace.update(self.globals)
+
+  def cleanup(self):
+    storage.cleanup_script_module(self.module)
+
+# Transformations keep what a run found out (metadata, the output manifest) on
+# themselves, so every run gets its own copy to fill in
+def fresh(transformation):
+  run = copy.copy(transformation)
+  run.metadata = dict()
+  run.output_manifest = None
+  return run
+
+class Worker:
+  def __init__(self, cache_size=DEFAULT_CACHE_SIZE):
+    self.cache_size = cache_size
+    self.scripts = OrderedDict()
+    # Runs of the same script share its module, so they take turns
+    self.lock = Lock()
+
+  # Scripts are cached by a hash of their code, so an edited script is loaded
+  # as a new one and the old version is dropped once it's least recently used
+  def script(self, code):
+    key = hashlib.sha256(code.encode('utf-8')).hexdigest()
+    script = self.scripts.get(key)
+    if script is None:
+      script = Script(code)
+      self.scripts[key] = script
+      while len(self.scripts) > self.cache_size:
+        _, evicted = self.scripts.popitem(last=False)
+        evicted.cleanup()
+
+    self.scripts.move_to_end(key)
+    return script
+
+  def run(self, request):
+    code = request.get('code')
+    if code is None and request.get('path'):
+      with open(request['path'], encoding='utf-8') as script:
+        code = script.read()
+    if code is None:
+      raise ValueError("Request needs either code or a path to a script")
+
+    with self.lock:
+      script = self.script(code)
+      transformation = fresh(script.transformation(request.get('transformation')))
+      try:
+        transformation.run(request['params'])
+      finally:
+        script.reset()
+
+    return transformation.metadata
+
+  def handle(self, line):
+    start = time.perf_counter()
+    request = dict()
+    try:
+      request = json.loads(line)
+      metadata = self.run(request)
+    except Exception as e:
+      return dict(id=request.get('id'), status='error', error=f"{type(e).__name__}: {e}")
+
+    return dict(id=request.get('id'), status='ok', metadata=metadata, elapsed=time.perf_counter() - start)
+
+  def serve(self, requests, responses):
+    for line in requests:
+      if not line.strip():
+        continue
+
+      # Transformations print what they're up to as they go, which would end
+      # up mixed in with the responses
+      with redirect_stdout(sys.stderr):
+        response = self.handle(line)
+
+      responses.write(json.dumps(response, default=str) + '\n')
+      responses.flush()
+
+  def close(self):
+    with self.lock:
+      while self.scripts:
+        _, script = self.scripts.popitem()
+        script.cleanup()
+
+# Gets everything a first run would otherwise have to wait on out of the way
+def warm_up():
+  import pandas
+  from . import profiling, serializers, stream_transformation
+  storage.session()
+  storage.magic()
+
+# Takes requests over a unix socket instead, one connection at a time, each
+# with as many requests as it likes
+def serve_socket(worker, path):
+  class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+      requests = io.TextIOWrapper(self.rfile, encoding='utf-8')
+      responses = io.TextIOWrapper(self.wfile, encoding='utf-8', write_through=True)
+      worker.serve(requests, responses)
+      responses.detach()
+      requests.detach()
+
+  # Left over from a worker that didn't get to clean up
+  if os.path.exists(path):
+    os.unlink(path)
+
+  try:
+    with socketserver.UnixStreamServer(path, Handler) as server:
+      server.serve_forever()
+  finally:
+    if os.path.exists(path):
+      os.unlink(path)
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Runs synthi transformations sent as JSON lines, keeping scripts loaded in between")
+  parser.add_argument('--socket', help="listen on this unix socket rather than stdin")
+  parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE, help="how many scripts to keep loaded")
+  args = parser.parse_args(argv)
+
+  # Being told to stop is the usual way out, and scripts still get cleaned up
+  signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+  warm_up()
+  worker = Worker(cache_size=args.cache_size)
+  try:
+    if args.socket:
+      serve_socket(worker, args.socket)
+    else:
+      worker.serve(sys.stdin, sys.stdout)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    worker.close()
+
+if __name__ == '__main__':
+  main()
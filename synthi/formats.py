@@ -0,0 +1,119 @@
+import io
+import sys
+from importlib import import_module
+
+from .columnar import pyarrow, iter_frames, to_pandas
+
+# Whether `data` is a DataFrame, without importing pandas to find out. pandas
+# is only imported once something needs it, and until then nothing could have
+# made a DataFrame anyway.
+def is_frame(data):
+  pandas = sys.modules.get('pandas')
+  return pandas is not None and type(data) is pandas.DataFrame
+
+# Decoders turn a dataset body into a DataFrame, or an iterator of DataFrames
+# when given a chunksize. They're picked by the Content-Type the server sends,
+# falling back on the format that was asked for and finally on CSV, which is
+# what Synthi serves unless told otherwise.
+#
+# `requires` names an optional module the decoder can't do without. Its
+# content types are only asked for (see accept_header) when it's installed.
+DECODERS = {}
+FORMAT_DECODERS = {}
+REQUIREMENTS = {}
+
+def register_decoder(content_types, formats, decode, requires=None):
+  for content_type in content_types:
+    DECODERS[content_type] = decode
+    REQUIREMENTS[content_type] = requires
+  for format in formats:
+    FORMAT_DECODERS[format] = decode
+
+def decoder_for(content_type=None, format=None):
+  content_type = (content_type or '').split(';')[0].strip().lower()
+  return DECODERS.get(content_type) or FORMAT_DECODERS.get(format) or decode_csv
+
+# Whether each optional module imports, so that's only tried once
+__installed = {}
+
+def installed(module):
+  if module not in __installed:
+    try:
+      import_module(module)
+      __installed[module] = True
+    except ImportError:
+      __installed[module] = False
+  return __installed[module]
+
+# Sent along with downloads so the server knows what we can read. CSV is
+# preferred over the rest, and nothing we couldn't decode is asked for.
+def accept_header():
+  accepted = []
+  for content_type, decode in DECODERS.items():
+    requires = REQUIREMENTS[content_type]
+    if requires and not installed(requires):
+      continue
+    accepted.append(content_type if decode is decode_csv else f"{content_type};q=0.9")
+  return ', '.join(accepted + ['*/*;q=0.1'])
+
+def decode_csv(source, usecols=None, dtype=None, chunksize=None):
+  import pandas as pd
+  return pd.read_csv(source, usecols=usecols, dtype=dtype, chunksize=chunksize)
+
+def decode_jsonlines(source, usecols=None, dtype=None, chunksize=None):
+  import pandas as pd
+  # pandas only reads JSON lines in chunks from text streams
+  frames = pd.read_json(io.TextIOWrapper(source, encoding='utf-8'), lines=True, dtype=dtype, chunksize=chunksize)
+  if not usecols:
+    return frames
+  elif chunksize:
+    return (frame[usecols] for frame in frames)
+  else:
+    return frames[usecols]
+
+# Parquet keeps its footer at the end, so there's no reading it as it arrives
+def decode_parquet(source, usecols=None, dtype=None, chunksize=None):
+  pa = pyarrow()
+  from pyarrow import parquet
+
+  buffer = pa.BufferReader(source.read())
+  if chunksize:
+    return iter_frames(parquet.ParquetFile(buffer).iter_batches(batch_size=chunksize, columns=usecols), dtype=dtype)
+  return to_pandas(parquet.read_table(buffer, columns=usecols), dtype=dtype)
+
+# The Arrow IPC stream format can be read batch by batch straight off the wire
+def decode_arrow_stream(source, usecols=None, dtype=None, chunksize=None):
+  pa = pyarrow()
+  reader = pa.ipc.open_stream(source)
+  return read_arrow(reader, usecols=usecols, dtype=dtype, chunksize=chunksize)
+
+def decode_arrow_file(source, usecols=None, dtype=None, chunksize=None):
+  pa = pyarrow()
+  reader = pa.ipc.open_file(pa.BufferReader(source.read()))
+  return read_arrow(reader, usecols=usecols, dtype=dtype, chunksize=chunksize)
+
+def read_arrow(reader, usecols=None, dtype=None, chunksize=None):
+  if chunksize:
+    batches = (batch.select(usecols) if usecols else batch for batch in iter_batches(reader))
+    return iter_frames(rebatch(batches, chunksize), dtype=dtype)
+
+  table = reader.read_all()
+  return to_pandas(table.select(usecols) if usecols else table, dtype=dtype)
+
+def iter_batches(reader):
+  if hasattr(reader, 'num_record_batches'):
+    for i in range(reader.num_record_batches):
+      yield reader.get_batch(i)
+  else:
+    yield from reader
+
+def rebatch(batches, chunksize):
+  for batch in batches:
+    for offset in range(0, batch.num_rows, chunksize):
+      yield batch.slice(offset, chunksize)
+
+register_decoder(['text/csv', 'application/csv'], ['csv'], decode_csv)
+register_decoder(['application/vnd.apache.parquet', 'application/x-parquet', 'application/parquet'], ['parquet'], decode_parquet, requires='pyarrow')
+register_decoder(['application/vnd.apache.arrow.stream'], ['arrow-stream'], decode_arrow_stream, requires='pyarrow')
+register_decoder(['application/vnd.apache.arrow.file'], ['arrow', 'feather'], decode_arrow_file, requires='pyarrow')
+register_decoder(['application/x-ndjson', 'application/jsonl', 'application/jsonlines', 'application/json-lines'], ['jsonl', 'ndjson'], decode_jsonlines)
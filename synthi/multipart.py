@@ -0,0 +1,164 @@
+import os
+import json
+import uuid
+import mimetypes
+
+CHUNK_SIZE = 1024 * 1024
+CSV_CHUNK_ROWS = 10000
+
+# Encodes a DataFrame as CSV a block of rows at a time, so that only one block's
+# worth of text is around at once instead of the whole file.
+def iter_csv_chunks(df, chunk_rows=CSV_CHUNK_ROWS):
+  for start in range(0, max(len(df), 1), chunk_rows):
+    yield df.iloc[start:start+chunk_rows].to_csv(index=False, header=(start == 0)).encode('utf-8')
+
+# Something we can send as a file part: a path, an open file-like object or a
+# DataFrame (sent as CSV). Paths are opened lazily and closed again by close(),
+# file-like objects are left open for whoever handed them to us.
+class UploadFile:
+  def __init__(self, file, chunk_size=CHUNK_SIZE):
+    self.chunk_size = chunk_size
+    self.__file = file
+    self.__opened = None
+
+    if isinstance(file, (str, os.PathLike)):
+      self.name = os.path.basename(file)
+      self.size = os.path.getsize(file)
+    elif hasattr(file, 'to_csv'):
+      self.name = 'data.csv'
+      self.size = None
+    elif hasattr(file, 'read'):
+      name = getattr(file, 'name', None)
+      self.name = os.path.basename(name) if isinstance(name, str) else 'upload'
+      self.size = remaining_size(file)
+    else:
+      raise TypeError(f"Don't know how to upload {type(file).__name__}, expected a path, file-like object or DataFrame")
+
+    self.mimetype = mimetypes.guess_type(self.name)[0] or 'application/octet-stream'
+
+  def __iter__(self):
+    file = self.__file
+
+    if hasattr(file, 'to_csv'):
+      yield from iter_csv_chunks(file)
+      return
+
+    if isinstance(file, (str, os.PathLike)):
+      file = self.__opened = open(file, 'rb')
+
+    while True:
+      chunk = file.read(self.chunk_size)
+      if not chunk:
+        break
+      yield chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+
+  def close(self):
+    if self.__opened:
+      self.__opened.close()
+      self.__opened = None
+
+def remaining_size(file):
+  try:
+    position = file.tell()
+    end = file.seek(0, os.SEEK_END)
+    file.seek(position)
+    # Text mode files count characters, not bytes, so we can't trust them
+    return end - position if 'b' in getattr(file, 'mode', 'b') else None
+  except (AttributeError, OSError, ValueError):
+    return None
+
+# Produces a multipart/form-data body following the GraphQL multipart request
+# spec (https://github.com/jaydenseric/graphql-multipart-request-spec) a chunk
+# at a time, so file contents never have to be held in memory. `files` maps
+# each form field name to an UploadFile, and `map` says which variables in the
+# operations those fields fill in.
+#
+# requests will stream anything with a read() method. When every part has a
+# known size we also expose `len` so that a Content-Length gets sent; otherwise
+# the body goes out with chunked transfer encoding.
+class MultipartEncoder:
+  def __init__(self, operations, map, files, progress=None):
+    self.boundary = uuid.uuid4().hex
+    self.content_type = f"multipart/form-data; boundary={self.boundary}"
+    self.progress = progress
+
+    self.__parts = [
+      (self.__header('operations', content_type='application/json'), operations.encode('utf-8')),
+      (self.__header('map', content_type='application/json'), json.dumps(map).encode('utf-8')),
+    ] + [
+      (self.__header(name, filename=file.name, content_type=file.mimetype), file)
+      for name, file in files.items()
+    ]
+    self.__closing = f"--{self.boundary}--\r\n".encode('utf-8')
+
+    sizes = [len(body) if isinstance(body, bytes) else body.size for _, body in self.__parts]
+    if None not in sizes:
+      self.len = sum(len(header) + size + 2 for (header, _), size in zip(self.__parts, sizes)) + len(self.__closing)
+
+    self.__chunks = None
+    self.__current = b''
+    self.__offset = 0
+    self.__sent = 0
+
+  def __header(self, name, filename=None, content_type=None):
+    disposition = f'form-data; name="{name}"'
+    if filename:
+      disposition += f'; filename="{filename}"'
+
+    header = f"--{self.boundary}\r\nContent-Disposition: {disposition}\r\n"
+    if content_type:
+      header += f"Content-Type: {content_type}\r\n"
+
+    return f"{header}\r\n".encode('utf-8')
+
+  def __generate(self):
+    for header, body in self.__parts:
+      yield header
+      if isinstance(body, bytes):
+        yield body
+      else:
+        try:
+          yield from body
+        finally:
+          body.close()
+      yield b'\r\n'
+    yield self.__closing
+
+  def __iter__(self):
+    for chunk in self.__generate():
+      self.__report(len(chunk))
+      yield chunk
+
+  def read(self, size=-1):
+    if self.__chunks is None:
+      self.__chunks = self.__generate()
+
+    # Hand out slices of the current chunk rather than growing and re-slicing
+    # one buffer, which would copy a whole chunk for every small read.
+    pieces = []
+    wanted = size
+    while size < 0 or wanted > 0:
+      if self.__offset >= len(self.__current):
+        self.__current = next(self.__chunks, b'')
+        self.__offset = 0
+        if not self.__current:
+          break
+
+      end = len(self.__current) if size < 0 else min(len(self.__current), self.__offset + wanted)
+      pieces.append(self.__current[self.__offset:end])
+      wanted -= end - self.__offset
+      self.__offset = end
+
+    data = b''.join(pieces)
+    self.__report(len(data))
+    return data
+
+  def __report(self, sent):
+    self.__sent += sent
+    if self.progress and sent:
+      self.progress(self.__sent, getattr(self, 'len', None))
+
+  def close(self):
+    for _, body in self.__parts:
+      if not isinstance(body, bytes):
+        body.close()
@@ -1,11 +1,23 @@
-from .common import gql_query
-from .api_base import APIBase
+from .api_base import APIBase, operation, query
+
+ORGANIZATIONS_QUERY = '''
+  query {
+    currentUser {
+      organizations {
+        name
+        id
+        uuid
+      }
+    }
+  }
+'''
 
 class OrganizationAPI(APIBase):
   def __init__(self, connection):
     super().__init__(connection)
     self.__default_org = None
 
+  @operation
   def set_default(self, name=None, uuid=None, id=None):
     assert name or uuid or id, "Must supply one of name, uuid, or id"
 
@@ -19,17 +31,7 @@ class OrganizationAPI(APIBase):
       org_key = 'id'
       org_val = id
 
-    info = gql_query('''
-      query {
-        currentUser {
-          organizations {
-            name
-            id
-            uuid
-          }
-        }
-      }
-    ''', connection=self._connection)
+    info = yield query(ORGANIZATIONS_QUERY)
 
     organizations = info['currentUser']['organizations']
 
@@ -40,19 +42,10 @@ class OrganizationAPI(APIBase):
     
     self.__default_org = matching_orgs[0]
 
+  @operation
   def default(self):
     if not self.__default_org:
-      info = gql_query('''
-      query {
-        currentUser {
-          organizations {
-            name
-            id
-            uuid
-          }
-        }
-      }
-      ''', connection=self._connection)
+      info = yield query(ORGANIZATIONS_QUERY)
       self.__default_org = info['currentUser']['organizations'][0]
     
     return self.__default_org
@@ -0,0 +1,62 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+DEFAULT_TTL = 300
+DEFAULT_MAXSIZE = 1024
+
+# Maps (organization uuid, kind, name) to a uuid. Entries expire after `ttl`
+# seconds so that renames and deletes made by someone else eventually get
+# picked up, and the least recently used entries are dropped once we go over
+# `maxsize`. A ttl or maxsize of 0 turns the cache off.
+class ResolutionCache:
+  def __init__(self, ttl=DEFAULT_TTL, maxsize=DEFAULT_MAXSIZE):
+    self.ttl = ttl
+    self.maxsize = maxsize
+    self.__entries = OrderedDict()
+    self.__lock = Lock()
+
+  def get(self, org, kind, name):
+    key = (org, kind, name)
+    with self.__lock:
+      entry = self.__entries.get(key)
+      if not entry:
+        return None
+
+      uuid, expires = entry
+      if expires < time.monotonic():
+        del self.__entries[key]
+        return None
+
+      self.__entries.move_to_end(key)
+      return uuid
+
+  def set(self, org, kind, name, uuid):
+    if not self.ttl or not self.maxsize or not name or not uuid:
+      return
+
+    key = (org, kind, name)
+    with self.__lock:
+      self.__entries[key] = (uuid, time.monotonic() + self.ttl)
+      self.__entries.move_to_end(key)
+      while len(self.__entries) > self.maxsize:
+        self.__entries.popitem(last=False)
+
+  def invalidate(self, org=None, kind=None, name=None, uuid=None):
+    with self.__lock:
+      stale = [
+        key for key, (entry_uuid, _) in self.__entries.items()
+        if (org is None or key[0] == org)
+        and (kind is None or key[1] == kind)
+        and (name is None or key[2] == name)
+        and (uuid is None or entry_uuid == uuid)
+      ]
+      for key in stale:
+        del self.__entries[key]
+
+  def clear(self):
+    with self.__lock:
+      self.__entries.clear()
+
+  def __len__(self):
+    return len(self.__entries)
@@ -0,0 +1,133 @@
+import io
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_PARTS = 8
+# Below this, the extra requests cost more than they save
+MIN_PARALLEL_SIZE = 32 * 1024 * 1024
+
+# Raised when the object changed between the HEAD and the range requests (or
+# partway through them), so the pieces can't be put together. Callers should
+# start over with a plain GET.
+class ObjectChanged(Exception):
+  pass
+
+# Whether a HEAD response says we can fetch the body in byte ranges. Ranges
+# index into the encoded body, so anything compressed in transit is out. There
+# also has to be some way of telling if the object changes in the meantime.
+def accepts_ranges(response, min_size=MIN_PARALLEL_SIZE):
+  headers = response.headers
+  return (
+    response.status_code == 200
+    and headers.get('Accept-Ranges', '').lower() == 'bytes'
+    and 'Content-Encoding' not in headers
+    and int(headers.get('Content-Length') or 0) >= min_size
+    and bool(range_preconditions(response))
+  )
+
+# Headers that make every range request fail (with a 412) unless the object is
+# still the one the HEAD described. If-Match needs a strong ETag, otherwise
+# Last-Modified is the best there is.
+def range_preconditions(head):
+  etag = head.headers.get('ETag')
+  if etag and not etag.startswith('W/'):
+    return { 'If-Match': etag }
+  if head.headers.get('Last-Modified'):
+    return { 'If-Unmodified-Since': head.headers['Last-Modified'] }
+  return {}
+
+def probe(session, url, headers=None, timeout=None):
+  return session.head(url, headers={ **(headers or {}), 'Accept-Encoding': 'identity' }, timeout=timeout, allow_redirects=True)
+
+# The range requests go straight to wherever probe() was redirected to. requests
+# only drops Authorization when it follows a redirect to another host itself,
+# so do the same here rather than hand our API key to the storage host.
+def redirect_headers(headers, url, original_url):
+  if urlparse(url).hostname == urlparse(original_url).hostname:
+    return headers
+  return { name: value for name, value in headers.items() if name.lower() != 'authorization' }
+
+# Fetches `size` bytes from `url` as `parts` concurrent range requests, each
+# written straight into its own slice of one preallocated buffer, so the
+# pieces never need to be joined. `head` is the probe() response the size came
+# from; every range is only served if the object still matches it.
+def download_ranges(session, url, size, head, headers=None, parts=DEFAULT_PARTS, timeout=None):
+  preconditions = range_preconditions(head)
+  buffer = bytearray(size)
+  view = memoryview(buffer)
+  part_size = -(-size // parts)
+
+  def fetch(start):
+    end = min(start + part_size, size) - 1
+    range_headers = { **(headers or {}), **preconditions, 'Range': f"bytes={start}-{end}", 'Accept-Encoding': 'identity' }
+    with session.get(url, headers=range_headers, timeout=timeout, stream=True) as response:
+      # A 200 is the whole (possibly new) object rather than our range
+      if response.status_code in (200, 412):
+        raise ObjectChanged(f"{url} changed while reading it in ranges")
+      if response.status_code != 206:
+        raise Exception(f"Failed to read bytes {start}-{end} of {url} got {response.status_code}")
+
+      offset = start
+      for chunk in response.iter_content(chunk_size=1024*1024):
+        view[offset:offset + len(chunk)] = chunk
+        offset += len(chunk)
+
+      if offset != end + 1:
+        raise Exception(f"Failed to read bytes {start}-{end} of {url}, got {offset - start} bytes")
+
+  with ThreadPoolExecutor(max_workers=parts) as pool:
+    # list() so that any failure gets raised here
+    list(pool.map(fetch, range(0, size, part_size)))
+
+  return buffer
+
+# Splits CSV data on line boundaries into up to `workers` pieces and parses
+# them concurrently, each with the header's column names. This assumes no
+# quoted field has a newline in it, so it's only used when asked for.
+#
+# Column types are worked out from the first piece and the rest are read with
+# them, so that no column ends up with a different type from one piece to the
+# next. If a later piece doesn't fit those (say, a column of whole numbers
+# with a gap further down), the whole thing is read again in one go, to come
+# out just as pd.read_csv would have.
+def read_csv_parallel(data, workers=DEFAULT_PARTS, **params):
+  import pandas as pd
+
+  view = memoryview(data)
+  header_end = data.find(b'\n') + 1
+  if not header_end or workers < 2:
+    return pd.read_csv(io.BytesIO(view), **params)
+
+  names = pd.read_csv(io.BytesIO(view[:header_end]), nrows=0, encoding=params.get('encoding')).columns
+
+  bounds = [header_end]
+  step = max(1, (len(data) - header_end) // workers)
+  for i in range(1, workers):
+    newline = data.find(b'\n', max(header_end + i * step, bounds[-1]))
+    if newline == -1 or newline + 1 >= len(data):
+      break
+    bounds.append(newline + 1)
+  bounds.append(len(data))
+
+  def parse(piece, params=params):
+    start, end = piece
+    return pd.read_csv(io.BytesIO(view[start:end]), header=None, names=names, **params)
+
+  pieces = [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+  if not pieces:
+    return pd.read_csv(io.BytesIO(view), **params)
+
+  first = parse(pieces[0])
+  rest_params = params
+  if not params.get('dtype') or isinstance(params['dtype'], dict):
+    # Dates are only ever parsed through parse_dates, not given as a dtype
+    inferred = { column: dtype for column, dtype in first.dtypes.items() if dtype.kind not in 'Mm' }
+    rest_params = { **params, 'dtype': { **inferred, **(params.get('dtype') or {}) } }
+
+  try:
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+      partitions = [first] + list(pool.map(lambda piece: parse(piece, rest_params), pieces[1:]))
+  except (ValueError, TypeError, OverflowError):
+    return pd.read_csv(io.BytesIO(view), **params)
+
+  return pd.concat(partitions, ignore_index=True)
@@ -1,11 +1,88 @@
 import os
 from typing import Dict
 
-from .common import gql_query, read_code, is_uuid
-from .api_base import OrganizationAwareAPI
+from .common import read_code, is_uuid
+from .api_base import OrganizationAwareAPI, operation, query
+
+
+CREATE_TRANSFORMATION_TEMPLATE_MUTATION = '''
+  mutation CreateTransformationTemplate($name: String!, $description: String, $inputs: [String], $code: String!, $owner: OrganizationRef!, $tags: [String]) {
+    createTransformationTemplate(
+      name: $name,
+      description: $description,
+      inputs: $inputs,
+      code: $code,
+      owner: $owner,
+      tagNames: $tags
+    ) {
+      id
+      uuid
+      name
+      description
+      inputs
+      code
+      tags {
+        name
+      }
+    }
+  }
+'''
+
+TRANSFORMATION_META_QUERY = '''
+  query ($org: OrganizationRef, $transformationUuid: String, $transformationName: String) {
+    transformation(org: $org, uuid: $transformationUuid, name: $transformationName) {
+      id
+      name
+      uuid
+    }
+  }
+'''
+
+UPDATE_TRANSFORMATION_MUTATION = '''
+  mutation UpdateTransformation($uuid: String!, $name: String, $description: String, $inputs: [String], $code: String, $tags: [String]) {
+    updateTransformation(uuid: $uuid, fields: {name: $name, description: $description, inputs: $inputs, code: $code, tagNames: $tags}) {
+      uuid
+      name
+      description
+      inputs
+      code
+      tags {
+        name
+      }
+    }
+  }
+'''
+
+DELETE_TRANSFORMATION_MUTATION = '''
+  mutation DeleteTransformation($uuid: String!) {
+    deleteTransformation(uuid: $uuid)
+  }
+'''
+
+TRANSFORMATION_LIST_QUERY = '''
+  query ($org: OrganizationRef!) {
+    listTransformations(org: $org) {
+      transformations {
+        id
+        name
+        uuid
+      }
+    }
+  }
+'''
 
+TRANSFORMATION_META_FIELD = 'transformation(org: $org, uuid: $transformationUuid, name: $transformationName) { id name uuid }'
+
+def meta_variables(uuid_or_name):
+  if not is_uuid(uuid_or_name):
+    return dict(transformationUuid=None, transformationName=uuid_or_name)
+  else:
+    return dict(transformationUuid=uuid_or_name, transformationName=None)
 
 class TransformationAPI(OrganizationAwareAPI):
+  _kind = 'transformation'
+
+  @operation
   def define(self, name, path=None, code=None, inputs=[], tags=[], description=''):
     if not path and not code:
       raise ValueError("Need to either give a path to a transformation code file or the code itself")
@@ -13,122 +90,75 @@ class TransformationAPI(OrganizationAwareAPI):
     if path and code:
       raise ValueError("Give either a path to a transformation code file or code, not both")
 
-    org = self._connection.organization.default()
+    org = yield from self._default_organization()
 
     if code is None:
       code = read_code(path)
 
-    query = '''
-      mutation CreateTransformationTemplate($name: String!, $description: String, $inputs: [String], $code: String!, $owner: OrganizationRef!, $tags: [String]) {
-        createTransformationTemplate(
-          name: $name,
-          description: $description,
-          inputs: $inputs,
-          code: $code,
-          owner: $owner,
-          tagNames: $tags
-        ) {
-          id
-          uuid
-          name
-          description
-          inputs
-          code
-          tags {
-            name
-          }
-        }
-      }
-    '''
-
     variables = {'name':name, 'description': description, 'inputs': inputs, 'code': code, 'owner': org, 'tags': tags}
-    result = gql_query(query, variables=variables, connection=self._connection)
+    result = yield query(CREATE_TRANSFORMATION_TEMPLATE_MUTATION, variables=variables)
+    yield from self._remember(result['createTransformationTemplate'])
 
     return result['createTransformationTemplate']
 
+  @operation
   def meta(self, uuid_or_name):
-    transformationUuid = None
-    transformationName = None
+    variables = dict(
+      org = (yield from self._default_organization()),
+      **meta_variables(uuid_or_name)
+    )
 
-    if not is_uuid(uuid_or_name):
-      transformationName = uuid_or_name
-    else:
-      transformationUuid = uuid_or_name
+    results = yield query(TRANSFORMATION_META_QUERY, variables=variables)
 
-    query = '''
-    query ($org: OrganizationRef, $transformationUuid: String, $transformationName: String) {
-      transformation(org: $org, uuid: $transformationUuid, name: $transformationName) {
-        id
-        name
-        uuid
-      }
-    }
-    '''
+    return results['transformation']
 
-    variables = dict(
-      org = self._default_organization(),
-      transformationUuid = transformationUuid,
-      transformationName = transformationName
+  @operation
+  def meta_many(self, uuids_or_names, batch_size=None):
+    results = yield from self._batch(
+      'query', dict(org='OrganizationRef'), dict(transformationUuid='String', transformationName='String'),
+      TRANSFORMATION_META_FIELD, uuids_or_names,
+      shared=dict(org=(yield from self._default_organization())),
+      items=[meta_variables(uuid_or_name) for uuid_or_name in uuids_or_names],
+      batch_size=batch_size
     )
 
-    results = gql_query(query, variables=variables, connection=self._connection)
+    for item in results:
+      yield from self._remember(item.result)
 
-    return results['transformation']
+    return results
 
+  @operation
   def update(self, uuid_or_name, name=None, inputs=None, code=None, tags=None, description=''):
-    uuid = self._resolve_to_uuid(uuid_or_name)
+    uuid = yield from self._resolve_to_uuid(uuid_or_name)
     if not uuid:
       raise ValueError("Can't find the transformation to update")
 
-    query = '''
-    mutation UpdateTransformation($uuid: String!, $name: String, $description: String, $inputs: [String], $code: String, $tags: [String]) {
-      updateTransformation(uuid: $uuid, fields: {name: $name, description: $description, inputs: $inputs, code: $code, tagNames: $tags}) {
-        uuid
-        name
-        description
-        inputs
-        code
-        tags {
-          name
-        }
-      }
-    }
-    '''
-    result = gql_query(query, variables={'uuid':uuid, 'name':name, 'description':description, 'inputs':inputs, 'code':code, 'tags': tags}, connection=self._connection)
+    variables = {'uuid':uuid, 'name':name, 'description':description, 'inputs':inputs, 'code':code, 'tags': tags}
+    result = yield query(UPDATE_TRANSFORMATION_MUTATION, variables=variables)
+
+    # The name may have changed, so drop whatever pointed at this uuid before
+    self._forget(uuid=uuid)
+    yield from self._remember(result['updateTransformation'])
 
     return result['updateTransformation']
 
+  @operation
   def delete(self, uuid_or_name):
-    uuid = self._resolve_to_uuid(uuid_or_name)
+    uuid = yield from self._resolve_to_uuid(uuid_or_name)
     if not uuid:
       raise ValueError("Can't find the transformation to delete")
 
-    query = '''
-    mutation DeleteTransformation($uuid: String!) {
-      deleteTransformation(uuid: $uuid)
-    }
-    '''
-    result = gql_query(query, variables={'uuid':uuid}, connection=self._connection)
+    result = yield query(DELETE_TRANSFORMATION_MUTATION, variables={'uuid':uuid})
+    self._forget(uuid=uuid)
 
     return result['deleteTransformation']
 
+  @operation
   def list(self):
-    query = '''
-    query ($org: OrganizationRef!) {
-      listTransformations(org: $org) {
-        transformations {
-          id
-          name
-          uuid
-        }
-      }
-    }
-    '''
-
     variables = dict(
-      org = self._default_organization()
+      org = (yield from self._default_organization())
     )
 
-    results = gql_query(query, variables=variables, connection=self._connection)
+    results = yield query(TRANSFORMATION_LIST_QUERY, variables=variables)
 
     return results['listTransformations']['transformations']
@@ -1,3 +1,4 @@
+import io
 import os
 import pandas as pd
 from synthi.dev.transformation import Transformation, transformation, dataset
@@ -185,3 +186,406 @@ def test_stream_transformations():
 
   assert(os.path.exists(os.path.join(TEST_DATA_ROOT, "output/iris-means-streamed.imported.csv")))
   assert(os.path.exists(os.path.join(TEST_DATA_ROOT, "output/iris-means-streamed.sample.csv")))
+
+  # One sample drawn from the whole stream, rather than one per chunk
+  sample = pd.read_csv(os.path.join(TEST_DATA_ROOT, "output/iris-means-streamed.sample.csv"))
+  assert(len(sample) == 15)
+
+  # Every chunk (of 10 rows, so one species each) gets profiled, not just the first
+  assert(iris_means.metadata['profile']['rows'] == 15)
+  column_keys = set(iris_means.metadata['columns'][0].keys())
+  assert(column_keys - { 'name', 'order', 'originalName', 'tags' } == set())
+
+def test_resolution_cache():
+  from synthi.resolution_cache import ResolutionCache
+
+  cache = ResolutionCache(ttl=60, maxsize=2)
+  cache.set('org', 'dataset', 'a', 'uuid-a')
+  cache.set('org', 'dataset', 'b', 'uuid-b')
+  assert(cache.get('org', 'dataset', 'a') == 'uuid-a')
+
+  # 'b' is now the least recently used entry
+  cache.set('org', 'dataset', 'c', 'uuid-c')
+  assert(cache.get('org', 'dataset', 'b') is None)
+  assert(cache.get('org', 'transformation', 'a') is None)
+
+  cache.invalidate(kind='dataset', uuid='uuid-a')
+  assert(cache.get('org', 'dataset', 'a') is None)
+  assert(cache.get('org', 'dataset', 'c') == 'uuid-c')
+
+  expired = ResolutionCache(ttl=-1)
+  expired.set('org', 'dataset', 'a', 'uuid-a')
+  assert(expired.get('org', 'dataset', 'a') is None)
+
+def test_meta_many_warms_cache(monkeypatch):
+  import synthi.api_base
+  from synthi import Connection
+
+  def respond(document, connection=None, **params):
+    if 'currentUser' in document:
+      return dict(currentUser=dict(organizations=[dict(id=1, uuid='org-uuid', name='org')]))
+    return dict(item0=dict(id=1, name='first10', uuid='transformation-uuid')), []
+  monkeypatch.setattr(synthi.api_base, 'gql_query', respond)
+
+  connection = Connection(host='http://api')
+  results = connection.transformation.meta_many(['first10'])
+  assert(results[0].result['uuid'] == 'transformation-uuid')
+  assert(connection.resolution_cache.get('org-uuid', 'transformation', 'first10') == 'transformation-uuid')
+
+def test_batch_document():
+  from synthi.batch import batch_document, batch_variables, batch_results
+
+  query = batch_document('query', {'org': 'OrganizationRef'}, {'name': 'String'}, 'dataset(org: $org, name: $name) { uuid }', 2)
+  assert(query == (
+    "query ($org: OrganizationRef, $name0: String, $name1: String) {\n"
+    "  item0: dataset(org: $org, name: $name0) { uuid }\n"
+    "  item1: dataset(org: $org, name: $name1) { uuid }\n"
+    "}"
+  ))
+  assert(batch_variables({'org': 'o'}, [{'name': 'a'}, {'name': 'b'}]) == {'org': 'o', 'name0': 'a', 'name1': 'b'})
+
+  results = batch_results(['a', 'b'], {'item0': 'ok', 'item1': None}, [{'message': 'boom', 'path': ['item1']}])
+  assert(results[0].result == 'ok' and results[0].error is None)
+  assert(results[1].result is None and 'boom' in str(results[1].error))
+
+def test_content_cache(tmp_path):
+  from synthi.content_cache import ContentCache
+
+  cache = ContentCache(str(tmp_path), max_bytes=10)
+  assert(cache.validators('a', 'csv') == {})
+
+  file, entry = cache.store('a', 'csv', [b'12345', b'678'], etag='"v1"')
+  with file:
+    assert(file.read() == b'12345678')
+  assert(cache.validators('a', 'csv') == {'If-None-Match': '"v1"'})
+
+  # A newer copy replaces the validators and contents together, and the
+  # contents for the old entry are gone rather than paired with new validators
+  file, _ = cache.store('a', 'csv', [b'1234'], etag='"v2"')
+  file.close()
+  assert(cache.validators('a', 'csv') == {'If-None-Match': '"v2"'})
+  assert(cache.open('a', 'csv', entry) is None)
+
+  # Storing 'b' takes us over max_bytes, so the older 'a' gets evicted
+  file, _ = cache.store('b', 'csv', [b'abcdefg'], last_modified='Mon, 01 Jan 2024 00:00:00 GMT')
+  file.close()
+  assert(cache.open('a', 'csv') is None)
+  assert(cache.validators('a', 'csv') == {})
+  with cache.open('b', 'csv') as file:
+    assert(file.read() == b'abcdefg')
+
+def test_columnar_copy(tmp_path):
+  pytest.importorskip('pyarrow')
+  from synthi import columnar
+
+  for columnar_format in columnar.FORMATS:
+    path = str(tmp_path / f"iris.{columnar_format}")
+    with open(os.path.join(TEST_DATA_ROOT, "iris.csv"), 'rb') as source:
+      assert(columnar.convert(source, path, columnar_format))
+
+    df = columnar.read(path, columnar_format, usecols=['species'], filters=[('species', '=', 'setosa')])
+    assert(df.shape == (50, 1))
+
+    chunks = list(columnar.read(path, columnar_format, chunksize=100))
+    assert(sum(len(chunk) for chunk in chunks) == 150)
+
+    # Filtering on a column that isn't being read
+    df = columnar.read(path, columnar_format, usecols=['sepal_length'], filters=[('species', '=', 'setosa')])
+    assert(df.shape == (50, 1))
+    chunks = list(columnar.read(path, columnar_format, usecols=['sepal_length'], chunksize=20, filters=[('species', '=', 'virginica')]))
+    assert(sum(len(chunk) for chunk in chunks) == 50 and list(chunks[0].columns) == ['sepal_length'])
+
+def test_read_csv_parallel():
+  from synthi.transfer import read_csv_parallel
+
+  with open(os.path.join(TEST_DATA_ROOT, "iris.csv"), 'rb') as file:
+    data = file.read()
+
+  expected = pd.read_csv(os.path.join(TEST_DATA_ROOT, "iris.csv"))
+  for workers in (1, 4, 500):
+    pd.testing.assert_frame_equal(read_csv_parallel(data, workers=workers), expected)
+
+  # Whole numbers in the first piece and decimals or gaps later on still come
+  # out as one column type
+  data = b"a,b\n" + b"1,x\n" * 50 + b"2.5,y\n" * 50
+  assert(read_csv_parallel(data, workers=4)['a'].dtype == 'float64')
+  data = b"a,b\n" + b"1,x\n" * 50 + b",y\n" * 50
+  pd.testing.assert_frame_equal(read_csv_parallel(data, workers=4), pd.read_csv(io.BytesIO(data)))
+
+def test_download_ranges_changed():
+  from synthi.transfer import download_ranges, ObjectChanged
+
+  class Response:
+    def __init__(self, status_code, headers=None):
+      self.status_code = status_code
+      self.headers = headers or {}
+    def __enter__(self):
+      return self
+    def __exit__(self, *args):
+      pass
+    def iter_content(self, chunk_size):
+      return iter([b'x' * 10])
+
+  # The second range finds a different object than the HEAD described
+  class Session:
+    def __init__(self):
+      self.requests = []
+    def get(self, url, headers=None, **kwargs):
+      self.requests.append(headers)
+      return Response(206 if headers['Range'] == 'bytes=0-9' else 412)
+
+  session = Session()
+  head = Response(200, { 'ETag': '"v1"' })
+  with pytest.raises(ObjectChanged):
+    download_ranges(session, 'http://storage/object', 20, head, parts=2)
+  assert(all(headers['If-Match'] == '"v1"' for headers in session.requests))
+
+# The API redirects downloads to a storage host, which shouldn't get the API key
+def test_download_ranges_redirected(monkeypatch):
+  import synthi.dataset
+  from functools import partial
+  from synthi import Connection
+  from synthi.transfer import accepts_ranges
+
+  data = b"a,b\n" + b"1,x\n" * 20
+
+  class Response:
+    def __init__(self, status_code, headers, body=b''):
+      self.status_code = status_code
+      self.headers = headers
+      self.url = 'http://storage/object'
+      self.body = body
+    def __enter__(self):
+      return self
+    def __exit__(self, *args):
+      pass
+    def close(self):
+      pass
+    def iter_content(self, chunk_size):
+      return iter([self.body])
+
+  class Session:
+    def __init__(self):
+      self.requests = []
+    def head(self, url, headers=None, **kwargs):
+      return Response(200, { 'Accept-Ranges': 'bytes', 'Content-Length': str(len(data)), 'ETag': '"v1"', 'Content-Type': 'text/csv' })
+    def get(self, url, headers=None, **kwargs):
+      self.requests.append(headers)
+      start, end = (int(n) for n in headers['Range'][len('bytes='):].split('-'))
+      return Response(206, {}, data[start:end + 1])
+
+  monkeypatch.setattr(synthi.dataset, 'accepts_ranges', partial(accepts_ranges, min_size=0))
+  connection = Connection(host='http://api', api_key='secret')
+  connection.session = Session()
+
+  df = connection.dataset.get('0b6fd2c4-0a53-4c3e-9d6b-7d2a1f2e8c11', parallel=2)
+  assert(len(df) == 20)
+  assert(len(connection.session.requests) == 2)
+  assert(all('Authorization' not in headers for headers in connection.session.requests))
+
+def test_shared_memory_pack():
+  from synthi.dev.process_pool import pack, unpack
+
+  df = pd.read_csv(os.path.join(TEST_DATA_ROOT, "iris.csv"))
+  pd.testing.assert_frame_equal(unpack(pack(df)), df)
+  assert(unpack(pack({ 'a': 1 })) == { 'a': 1 })
+
+def test_dtype_tags():
+  from synthi.dev.transformation import convert_type
+
+  assert(convert_type('int32') == 'Integer')
+  assert(convert_type('Int64') == 'Integer')
+  assert(convert_type('float32') == 'Float')
+  assert(convert_type('boolean') == 'Boolean')
+  assert(convert_type(pd.CategoricalDtype([1.5, 2.5])) == 'Float')
+  assert(convert_type('datetime64[ns]') == 'String')
+
+def test_frame_encoder():
+  pytest.importorskip('pyarrow')
+  from io import BytesIO
+  from synthi.dev.serializers import FrameEncoder, open_parquet, open_arrow_stream
+  from synthi.formats import decode_parquet, decode_arrow_stream
+
+  df = pd.read_csv(os.path.join(TEST_DATA_ROOT, "iris.csv"))
+  for open_writer, decode in ((open_parquet, decode_parquet), (open_arrow_stream, decode_arrow_stream)):
+    encoder = FrameEncoder(open_writer)
+    data = b''.join([encoder.encode(df.iloc[:100]), encoder.encode(df.iloc[100:]), encoder.finish()])
+    pd.testing.assert_frame_equal(decode(BytesIO(data)), df)
+
+def test_param_stream_merge():
+  from synthi.dev.stream_transformation import ParamStream
+
+  iris = pd.read_csv(os.path.join(TEST_DATA_ROOT, "iris.csv")).sort_values('species')
+  names = pd.DataFrame({ 'species': ['setosa', 'versicolor', 'virginica'], 'name': ['a', 'b', 'c'] })
+
+  params = ParamStream({
+    'iris': (iris.iloc[i:i+7] for i in range(0, len(iris), 7)),
+    'names': (names.iloc[i:i+2] for i in range(0, len(names), 2))
+  }, align='merge', key='species')
+
+  joined = pd.concat([chunk['iris'].merge(chunk['names'], on='species') for chunk in params])
+  assert(len(joined) == 150)
+
+  # Each chunk is sorted, but the second goes back to keys before the first's
+  params = ParamStream({
+    'iris': iter([iris.iloc[50:60], iris.iloc[0:10]]),
+    'names': iter([names])
+  }, align='merge', key='species')
+  with pytest.raises(Exception, match='has to be sorted'):
+    list(params)
+
+def test_adaptive_chunks():
+  from synthi.dev.stream_transformation import AdaptiveChunks, frame_rows
+
+  iris = pd.read_csv(os.path.join(TEST_DATA_ROOT, "iris.csv"))
+  frames = (iris.iloc[i:i+7] for i in range(0, len(iris), 7))
+  row_bytes = iris.memory_usage(deep=True, index=False).sum() / len(iris)
+
+  chunks = AdaptiveChunks(frame_rows(frames), target_bytes=row_bytes * 40, first_rows=10)
+  sizes = [len(chunk) for chunk in chunks]
+  assert(sum(sizes) == 150 and sizes[0] == 10 and max(sizes) > 10)
+  assert(chunks.stats()['rows'] == 150)
+
+def test_sniff_csv():
+  from synthi.dev.storage import sniff_csv
+
+  params, conclusive = sniff_csv('id;name\n1;"Zoë; B"\n2;Ann\n'.encode('latin-1'))
+  assert(conclusive and params['sep'] == ';')
+  assert(params['encoding'] in ('iso-8859-1', 'latin-1'))
+
+  # Plain ASCII might still turn out to be something else further on
+  params, conclusive = sniff_csv(b'a,b\n1,2\n')
+  assert(not conclusive and params['encoding'] == 'utf-8')
+
+# Importing the package (or the dev modules a transformation script starts
+# with) shouldn't load pandas, httpx or libmagic before they're needed, and
+# shouldn't slow down again as things get added
+IMPORT_TIME_BUDGET = 0.25
+
+def test_import_time():
+  import sys, json, subprocess
+
+  script = (
+    "import sys, json, time\n"
+    "start = time.perf_counter()\n"
+    "import synthi\n"
+    "elapsed = time.perf_counter() - start\n"
+    "import synthi.dev.stream_transformation\n"
+    "heavy = [m for m in ('pandas', 'numpy', 'httpx', 'magic', 'pyarrow') if m in sys.modules]\n"
+    "print(json.dumps(dict(elapsed=elapsed, heavy=heavy)))\n"
+  )
+  result = json.loads(subprocess.run([sys.executable, "-c", script], check=True, capture_output=True, text=True).stdout)
+  assert(result['heavy'] == [])
+  assert(result['elapsed'] < IMPORT_TIME_BUDGET)
+
+WORKER_SCRIPT = """
+import os
+import pandas as pd
+from synthi.dev.transformation import Transformation, transformation
+
+ROOT = {root!r}
+calls = 0
+
+def load(datamap, variant='imported'):
+  return pd.read_csv(os.path.join(ROOT, datamap['value'][variant]))
+
+def write(df, datamap, variant='imported'):
+  df.to_csv(os.path.join(ROOT, datamap['value'][variant]), index=False)
+
+class LocalTransformation(Transformation):
+  def record_storage_metadata(self, outputptr):
+    self.metadata['bytes'] = os.stat(os.path.join(ROOT, outputptr['value']['imported'])).st_size
+
+@transformation(LocalTransformation, loader=dict(default=load), writer=write)
+def first(iris):
+  global calls
+  calls += 1
+  return iris.head(calls)
+"""
+
+def test_worker():
+  import io, json
+  from synthi.dev.worker import Worker
+
+  code = WORKER_SCRIPT.format(root=TEST_DATA_ROOT)
+  params = {
+    "input": { "iris": { "value": { "imported": "iris.csv" }, "storage": "test-local", "format": "csv" } },
+    "output": {
+      "value": { "imported": "output/iris-worker.imported.csv", "sample": "output/iris-worker.sample.csv" },
+      "storage": "test-local",
+      "format": "csv"
+    }
+  }
+  requests = [
+    dict(id=1, code=code, params=params),
+    dict(id=2, code=code, transformation="first", params=params),
+    dict(id=3, code=code, transformation="missing", params=params),
+  ]
+
+  worker = Worker()
+  responses = io.StringIO()
+  worker.serve(io.StringIO("\n".join(json.dumps(request) for request in requests)), responses)
+  first, second, missing = [json.loads(line) for line in responses.getvalue().splitlines()]
+
+  # Loaded once, and the module's globals are back where they started for the
+  # second run
+  assert(len(worker.scripts) == 1)
+  assert(first['status'] == 'ok' and second['status'] == 'ok')
+  assert(first['metadata']['profile']['rows'] == 1 and second['metadata']['profile']['rows'] == 1)
+  assert(missing['status'] == 'error' and missing['id'] == 3)
+
+  path = next(iter(worker.scripts.values())).module.__file__
+  worker.close()
+  assert(not os.path.exists(path))
+
+def test_accept_header(monkeypatch):
+  from synthi import formats
+
+  # Without pyarrow, nothing that needs it gets asked for
+  monkeypatch.setattr(formats, 'installed', lambda module: False)
+  accepted = formats.accept_header().split(', ')
+  assert(accepted[0] == 'text/csv')
+  assert(not any('parquet' in content_type or 'arrow' in content_type for content_type in accepted))
+
+# Both clients run the same operations, so given the same responses they should
+# send the same requests and come back with the same results
+def test_sync_async_operations(monkeypatch):
+  import asyncio
+  import synthi.api_base, synthi.aio.api_base
+  from synthi import Connection, AsyncConnection
+
+  org = dict(id=1, uuid='org-uuid', name='org')
+
+  def respond(sent, document, **params):
+    sent.append((document, params.get('variables')))
+    if 'currentUser' in document:
+      return dict(currentUser=dict(organizations=[org]))
+    if 'createDataset' in document:
+      variables = params['variables']
+      data = {
+        f"item{i}": dict(uuid=f"uuid-{variables[f'datasetName{i}']}", name=variables[f'datasetName{i}'])
+        for i in range(len([name for name in variables if name.startswith('datasetName')]))
+      }
+      errors = [dict(message='taken', path=['item1'])] if 'datasetName1' in variables else []
+      return data, errors
+    raise Exception(f"Unexpected query: {document}")
+
+  sync_sent, async_sent = [], []
+  monkeypatch.setattr(synthi.api_base, 'gql_query', lambda document, connection=None, **params: respond(sync_sent, document, **params))
+
+  async def async_query(document, connection=None, **params):
+    return respond(async_sent, document, **params)
+  monkeypatch.setattr(synthi.aio.api_base, 'gql_query', async_query)
+
+  names = ['a', 'b', 'c']
+  expected = Connection(host='http://localhost').dataset.create_many(names, batch_size=2)
+
+  async def run():
+    async with AsyncConnection(host='http://localhost') as client:
+      return await client.dataset.create_many(names, batch_size=2)
+  results = asyncio.run(run())
+
+  assert([item.key for item in results] == names)
+  assert([item.result for item in results] == [item.result for item in expected])
+  assert([item.error is None for item in results] == [True, False, True])
+  assert(sorted(async_sent, key=str) == sorted(sync_sent, key=str))